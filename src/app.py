@@ -1,12 +1,33 @@
 import gradio as gr
+from gradio.components.plot import PlotData
 import requests
 import json
+import sys
+import time
+import inspect
+import functools
+import contextvars
+import hashlib
+import gzip
+import shutil
+import tempfile
+import threading
+import warnings
+import numpy as np
 import pandas as pd
-import plotly.express as px
+from pandas.api.types import union_categoricals
+import pyarrow as pa
 import plotly.graph_objects as go
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from datetime import datetime
+from typing import Literal
 import os
+import uvicorn
 from dotenv import load_dotenv
+from fastapi import Body, FastAPI, Query
+from fastapi.responses import JSONResponse, Response
 
 # Laad omgevingsvariabelen
 load_dotenv()
@@ -30,6 +51,113 @@ API_ENDPOINT_MAPPINGS = {
     }
 }
 
+# Hoe lang (in seconden) opgehaalde locatie- en parametercatalogi hergebruikt worden
+CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", "300"))
+# Hoe vaak (in seconden) de catalogi van de standaard webservices op de achtergrond worden
+# ververst; korter dan CATALOG_CACHE_TTL, zodat de cache bij het verbinden warm is
+CATALOG_WARMUP_INTERVAL = int(os.getenv("CATALOG_WARMUP_INTERVAL", "240"))
+
+# Hoe vaak (in seconden) de beschikbaarheidsindex van locatie-parameter combinaties wordt
+# ververst; 0 schakelt de index uit
+AVAILABILITY_REFRESH_INTERVAL = int(os.getenv("AVAILABILITY_REFRESH_INTERVAL", "3600"))
+# Aantal locaties per header-verzoek bij het opbouwen van de beschikbaarheidsindex
+AVAILABILITY_LOCATIONS_PER_REQUEST = int(os.getenv("AVAILABILITY_LOCATIONS_PER_REQUEST", "50"))
+# Aantal webservices buiten DEFAULT_API_URL en API_ENDPOINT_MAPPINGS waarvoor tegelijk een
+# index wordt bijgehouden. Een index stopt als de webservice AVAILABILITY_MAX_ERRORS keer
+# achter elkaar niet bereikbaar is (een nooit opgebouwde index direct) of als geen sessie
+# hem AVAILABILITY_IDLE_SECONDS heeft gebruikt
+AVAILABILITY_MAX_ENDPOINTS = int(os.getenv("AVAILABILITY_MAX_ENDPOINTS", "4"))
+AVAILABILITY_MAX_ERRORS = 3
+AVAILABILITY_IDLE_SECONDS = int(os.getenv("AVAILABILITY_IDLE_SECONDS", "86400"))
+
+# Grote selecties worden opgesplitst in deelverzoeken van maximaal dit aantal locaties,
+# zodat de eerste resultaten al getoond kunnen worden terwijl de rest nog binnenkomt
+TIMESERIES_LOCATIONS_PER_REQUEST = int(os.getenv("TIMESERIES_LOCATIONS_PER_REQUEST", "5"))
+# Aantal deelverzoeken dat tegelijk naar de webservice wordt gestuurd
+TIMESERIES_MAX_WORKERS = int(os.getenv("TIMESERIES_MAX_WORKERS", "4"))
+# Minimale tijd (in seconden) tussen tussentijdse updates van de grafiek en tabel
+PROGRESS_UPDATE_INTERVAL = float(os.getenv("PROGRESS_UPDATE_INTERVAL", "0.5"))
+# Maximale grootte (in MB) van één respons van de webservice. Voor het ophalen wordt de
+# omvang van de selectie geschat met een header-verzoek, waarna de selectie zo wordt
+# opgesplitst dat elk deelverzoek naar schatting ruim binnen deze grens blijft
+MAX_RESPONSE_MB = float(os.getenv("MAX_RESPONSE_MB", "20"))
+# Maximaal aantal events per opvraging; bij grotere selecties wordt de periode ingekort
+MAX_EVENTS_PER_QUERY = int(os.getenv("MAX_EVENTS_PER_QUERY", "5000000"))
+# Schatting vooraf in- of uitschakelen
+PREFLIGHT_ESTIMATION = os.getenv("PREFLIGHT_ESTIMATION", "true").lower() == "true"
+# Geschatte omvang van één event in een DD_JSON respons (in bytes)
+ESTIMATED_BYTES_PER_EVENT = 80
+# Deelverzoeken worden gepland op dit deel van MAX_RESPONSE_MB, als marge voor de schatting
+RESPONSE_PLANNING_FRACTION = 0.5
+
+# Interval (in seconden) waarmee de live modus nieuwe events ophaalt
+LIVE_POLL_INTERVAL = float(os.getenv("LIVE_POLL_INTERVAL", "60"))
+# Hoe lang (in uren, terugrekenend vanaf het nieuwste event) opgehaalde live events
+# bewaard blijven voor andere kijkers van dezelfde reeks
+LIVE_FEED_RETENTION_HOURS = float(os.getenv("LIVE_FEED_RETENTION_HOURS", "24"))
+# Een live feed die zo lang (in seconden) door geen kijker is gelezen, vervalt
+LIVE_FEED_IDLE_SECONDS = 10 * LIVE_POLL_INTERVAL
+# Map en maximale grootte (in MB) van de schijfcache met verwerkte tijdseries; 0 schakelt
+# de cache uit. Vermeldingen ouder dan SERIES_CACHE_TTL seconden worden opnieuw opgehaald
+SERIES_CACHE_DIR = os.getenv("SERIES_CACHE_DIR", os.path.join(tempfile.gettempdir(), "fews-explorer-series"))
+SERIES_CACHE_MAX_MB = int(os.getenv("SERIES_CACHE_MAX_MB", "1024"))
+SERIES_CACHE_TTL = int(os.getenv("SERIES_CACHE_TTL", "3600"))
+# Een periode zonder einddatum (of met een einddatum in de toekomst) loopt door tot nu; data
+# daarvan (in de sessie of de schijfcache) wordt maar zo veel seconden hergebruikt
+OPEN_PERIOD_MAX_AGE = float(os.getenv("OPEN_PERIOD_MAX_AGE", "10"))
+# Interval (in milliseconden) waarmee de profiler de call stacks bemonstert en het aantal
+# profielen dat bewaard blijft
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_HISTORY = int(os.getenv("PROFILE_HISTORY", "20"))
+# Het beheerpaneel (profilering voor het hele proces, profielen met bestandspaden en call
+# stacks) is alleen beschikbaar als ADMIN_PANEL=true
+ADMIN_PANEL = os.getenv("ADMIN_PANEL", "false").lower() == "true"
+# Tracing: "off" (standaard), "console" of "file" (spans als JSON-regels in TRACE_FILE)
+TRACING = os.getenv("TRACING", "off").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACING_ENABLED = TRACING in ("console", "file")
+# Aantal tijdseries-opvragingen dat tegelijk (over alle sessies) mag lopen
+TIMESERIES_CONCURRENCY_LIMIT = int(os.getenv("TIMESERIES_CONCURRENCY_LIMIT", "4"))
+# Blokgrootte (in bytes) waarmee responses van de webservice worden gelezen
+HTTP_CHUNK_SIZE = 64 * 1024
+# Maximale lengte (in tekens) van de komma-gescheiden locatie- en parameter-IDs in de query
+# string van één verzoek; langere selecties worden over meerdere verzoeken verdeeld
+MAX_QUERY_IDS_LENGTH = int(os.getenv("MAX_QUERY_IDS_LENGTH", "2000"))
+# Opnemen en afspelen van verzoeken aan de webservice: "live" (standaard), "record" (responses
+# opslaan in HTTP_ARCHIVE_DIR) of "replay" (alleen uit HTTP_ARCHIVE_DIR, met optioneel een
+# gesimuleerde vertraging in milliseconden)
+HTTP_MODE = os.getenv("HTTP_MODE", "live").lower()
+HTTP_ARCHIVE_DIR = os.getenv("HTTP_ARCHIVE_DIR", "recordings")
+REPLAY_LATENCY_MS = float(os.getenv("REPLAY_LATENCY_MS", "0"))
+# Maximale omvang (MB) van het resultaat dat per sessie bewaard blijft voor weergave-opties,
+# bladeren en live volgen
+SESSION_RESULT_MAX_MB = float(os.getenv("SESSION_RESULT_MAX_MB", "256"))
+# Geheugenbudget (MB) voor het hele proces: bewaarde sessieresultaten, de grafiekcache, de
+# catalogi, de live feeds en de beschikbaarheidsindex; 0 schakelt de begrenzing uit.
+# Sessieresultaten die niet in het budget (of boven SESSION_RESULT_MAX_MB) passen, worden als
+# Arrow-bestand naar SPILL_DIR geschreven en bij gebruik weer ingelezen
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "2048"))
+SPILL_DIR = os.getenv("SPILL_DIR", os.path.join(tempfile.gettempdir(), "fews-explorer-spill"))
+# Vergelijken van twee webservices: events worden gekoppeld aan het dichtstbijzijnde event
+# van dezelfde reeks binnen COMPARE_TOLERANCE_SECONDS; een reeks wijkt af als een verschil
+# groter is dan COMPARE_ATOL of als aan een van beide kanten events ontbreken
+COMPARE_TOLERANCE_SECONDS = float(os.getenv("COMPARE_TOLERANCE_SECONDS", "0"))
+COMPARE_ATOL = float(os.getenv("COMPARE_ATOL", "1e-6"))
+# Aggregaties voor de weergave: gemiddelde per periode (None = ruwe data)
+AGGREGATIONS = {"Ruw": None, "Uur": "60min", "Dag": "1D"}
+# Aantal geserialiseerde grafieken dat bewaard blijft voor herhaalde opvragingen; 0 schakelt de cache uit
+FIGURE_CACHE_SIZE = int(os.getenv("FIGURE_CACHE_SIZE", "32"))
+# Aantal rijen per pagina in de tabelweergave; de tabel wordt per pagina naar de browser gestuurd
+TABLE_PAGE_SIZE = int(os.getenv("TABLE_PAGE_SIZE", "100"))
+# Een interval tussen twee events telt als gat als het groter is dan deze factor maal de
+# tijdstap van de reeks (de meest voorkomende stap)
+GAP_FACTOR = 1.5
+# Maximaal aantal gaten (de langste eerst) in de tabel met gaten en in de arcering van de grafiek
+GAP_TABLE_MAX_ROWS = 1000
+# Percentielen waarmee een ensemble in de grafiek wordt samengevat: de buitenste paren worden
+# banden, een middelste percentiel een lijn
+ENSEMBLE_PERCENTILES = [float(p) for p in os.getenv("ENSEMBLE_PERCENTILES", "10,50,90").split(",")]
+
 # Deltares/FEWS huisstijl kleuren
 DELTARES_BLUE = "#0079C2"  # Primaire Deltares kleur
 DELTARES_DARK_BLUE = "#003D5F"
@@ -39,42 +167,609 @@ DELTARES_BLACK = "#000000"
 DELTARES_LIGHT_GREY = "#F0F0F0"
 DELTARES_DARK_GREY = "#606060"
 
+# Tellers voor het gebruik van de webservice, op te vragen via /api/v1/metrics
+METRICS = {
+    "upstream_requests": 0,
+    "upstream_bytes": 0,
+    "cancelled_requests": 0,
+    "cancelled_bytes": 0,
+    "superseded_queries": 0,
+    "oversized_responses": 0,
+    "series_cache_hits": 0,
+    "series_cache_misses": 0,
+    "series_cache_evictions": 0,
+    "figure_cache_hits": 0,
+    "figure_cache_misses": 0,
+    "recorded_responses": 0,
+    "replayed_responses": 0,
+    "spilled_results": 0,
+    "refused_queries": 0
+}
+_metrics_lock = threading.Lock()
+
+def record_metric(name, amount=1):
+    with _metrics_lock:
+        METRICS[name] = METRICS.get(name, 0) + amount
+
+def get_metrics():
+    with _metrics_lock:
+        return dict(METRICS)
+
+# Geheugenboekhouding per component ({component: {sleutel: bytes}}), op te vragen via
+# /api/v1/metrics. Bij een tekort wordt eerst de grafiekcache geleegd; sessieresultaten gaan
+# daarna naar schijf (zie hold_result) en nieuwe opvragingen worden geweigerd
+MEMORY_COMPONENTS = ("sessieresultaten", "lopende opvragingen", "grafiekcache", "catalogi", "live feeds", "beschikbaarheid")
+_memory = {component: {} for component in MEMORY_COMPONENTS}
+_memory_lock = threading.Lock()
+
+def account_memory(component, key, nbytes):
+    with _memory_lock:
+        _memory[component][key] = int(nbytes)
+
+def release_memory(component, key):
+    with _memory_lock:
+        _memory[component].pop(key, None)
+
+def memory_usage():
+    with _memory_lock:
+        return {component: sum(sizes.values()) for component, sizes in _memory.items()}
+
+# Vrije ruimte in het budget (bytes); wat al geboekt staat onder een van de boekingen in owned
+# ([(component, sleutel)]) telt als vrij, omdat het wordt vervangen
+def memory_available(owned=()):
+    if MEMORY_BUDGET_MB <= 0:
+        return float("inf")
+    with _memory_lock:
+        used = sum(sum(sizes.values()) for sizes in _memory.values())
+        used -= sum(_memory[component].get(key, 0) for component, key in owned)
+    return MEMORY_BUDGET_MB * 1024 * 1024 - used
+
+# Past nbytes in het budget? Zo nodig worden eerst verlopen catalogi en ongebruikte live
+# feeds opgeruimd en daarna de grafiekcache (oudste eerst) geleegd
+def memory_fits(nbytes, owned=()):
+    shortage = nbytes - memory_available(owned)
+    if shortage > 0:
+        expire_memory()
+        shortage = nbytes - memory_available(owned)
+    if shortage > 0:
+        evict_figure_cache(shortage)
+        shortage = nbytes - memory_available(owned)
+    return shortage <= 0
+
+# Verwijder catalogi ouder dan CATALOG_CACHE_TTL (die worden bij gebruik toch opnieuw
+# opgehaald) en live feeds die LIVE_FEED_IDLE_SECONDS niet gelezen zijn
+def expire_memory():
+    now = time.time()
+    with _catalog_cache_lock:
+        catalogs = [key for key, (stored, _) in _catalog_cache.items() if now - stored >= CATALOG_CACHE_TTL]
+        for key in catalogs:
+            del _catalog_cache[key]
+    with _live_feeds_lock:
+        feeds = [key for key, feed in _live_feeds.items() if now - feed["read"] > LIVE_FEED_IDLE_SECONDS]
+        for key in feeds:
+            del _live_feeds[key]
+    for key in catalogs:
+        release_memory("catalogi", key)
+    for key in feeds:
+        release_memory("live feeds", key)
+
+def reserve_memory(component, key, nbytes, owned=()):
+    if not memory_fits(nbytes, [(component, key), *owned]):
+        return False
+    account_memory(component, key, nbytes)
+    return True
+
+# Geheugen van een lopende opvraging: de opgehaalde deelresultaten worden geboekt, zodat
+# gelijktijdige opvragingen elkaars groei zien. owned zijn boekingen die het resultaat gaat
+# vervangen (het vorige resultaat van de sessie); de boeking vervalt met release
+class InFlightMemory:
+    def __init__(self, owned=()):
+        self.key = object()
+        self.owned = list(owned)
+        self.nbytes = 0
+    
+    # Boek een binnengekomen deelresultaat; False als de opvraging niet meer in het budget past
+    def add(self, chunk_df):
+        self.nbytes += frame_memory(chunk_df)
+        if not reserve_memory("lopende opvragingen", self.key, self.nbytes, self.owned):
+            record_metric("refused_queries")
+            return False
+        return True
+    
+    def refusal(self):
+        free_mb = max(0, memory_available([("lopende opvragingen", self.key), *self.owned])) / (1024 * 1024)
+        return (f"De opvraging is afgebroken: het resultaat (al {self.nbytes / (1024 * 1024):.0f} MB) past niet in het "
+                f"vrije geheugen van de app ({free_mb:.0f} van {MEMORY_BUDGET_MB:g} MB vrij). Verklein de selectie "
+                f"of de periode, of probeer het later opnieuw")
+    
+    def release(self):
+        release_memory("lopende opvragingen", self.key)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.release()
+
+# Geschatte omvang van een catalogus of index: DataFrames en arrays exact, overige objecten
+# via sys.getsizeof
+def object_memory(value):
+    if isinstance(value, pd.DataFrame):
+        return frame_memory(value)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(object_memory(k) + object_memory(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(object_memory(item) for item in value)
+    return sys.getsizeof(value)
+
+def frame_memory(df):
+    return int(df.memory_usage(deep=True).sum())
+
+# Wordt opgegooid wanneer een lopend verzoek is geannuleerd
+class QueryCancelled(Exception):
+    pass
+
+# Wordt opgegooid wanneer een respons groter is dan MAX_RESPONSE_MB
+class ResponseTooLarge(Exception):
+    pass
+
+# Wordt opgegooid wanneer een verzoek in de afspeelmodus niet is opgenomen
+class NotRecorded(Exception):
+    pass
+
+# Profilering op aanvraag. Als profilering in het beheerpaneel is ingeschakeld, wordt van
+# elke aanroep van update_api_url en fetch_timeseries een sampling-profiel opgenomen, met
+# per fase (webservice, JSON decodering, DataFrame, grafiek, serialisatie) de bestede tijd
+_profiling_enabled = threading.Event()
+_active_profile = contextvars.ContextVar("active_profile", default=None)
+_profiles = deque(maxlen=PROFILE_HISTORY)
+_profiles_lock = threading.Lock()
+
+class RequestProfile:
+    def __init__(self, name):
+        self.id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{name}-{id(self) % 10000:04d}"
+        self.name = name
+        self.started = time.time()
+        self.wall_time = None
+        self.stages = {}
+        self.samples = {}
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+    
+    # Threads die aan deze aanvraag werken worden bemonsterd
+    def attach_thread(self):
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.threads[thread_id] = self.threads.get(thread_id, 0) + 1
+    
+    def detach_thread(self):
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.threads[thread_id] -= 1
+            if not self.threads[thread_id]:
+                del self.threads[thread_id]
+    
+    @contextmanager
+    def activate(self):
+        token = _active_profile.set(self)
+        self.attach_thread()
+        try:
+            yield
+        finally:
+            self.detach_thread()
+            _active_profile.reset(token)
+    
+    def add_stage(self, stage, duration):
+        with self.lock:
+            total, count = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + duration, count + 1)
+    
+    def sample(self):
+        interval = PROFILE_SAMPLE_INTERVAL_MS / 1000
+        previous = time.perf_counter()
+        while not self.stopped.wait(interval):
+            now = time.perf_counter()
+            weight = (now - previous) * 1000
+            previous = now
+            frames = sys._current_frames()
+            with self.lock:
+                thread_ids = list(self.threads)
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                if stack:
+                    self.samples.setdefault(thread_id, []).append((stack[::-1], weight))
+    
+    # Exporteer de samples in het speedscope formaat (https://www.speedscope.app)
+    def to_speedscope(self):
+        frames = []
+        frame_index = {}
+        profiles = []
+        for thread_id, samples in self.samples.items():
+            indexed_samples = []
+            for stack, _ in samples:
+                indexed_stack = []
+                for frame in stack:
+                    if frame not in frame_index:
+                        frame_index[frame] = len(frames)
+                        frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                    indexed_stack.append(frame_index[frame])
+                indexed_samples.append(indexed_stack)
+            weights = [weight for _, weight in samples]
+            profiles.append({
+                "type": "sampled",
+                "name": f"{self.name} (thread {thread_id})",
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": indexed_samples,
+                "weights": weights
+            })
+        
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.id,
+            "exporter": "FEWS Webservices Explorer",
+            "shared": {"frames": frames},
+            "profiles": profiles
+        }
+
+def start_profile(name):
+    profile = RequestProfile(name)
+    threading.Thread(target=profile.sample, daemon=True).start()
+    return profile
+
+def finish_profile(profile):
+    profile.wall_time = time.time() - profile.started
+    profile.stopped.set()
+    with _profiles_lock:
+        _profiles.append(profile)
+
+# Tracing volgens het OpenTelemetry-model. Elke aanroep van een geprofileerde UI functie en
+# elk REST-verzoek wordt een trace: een boom van spans met een gezamenlijke trace-ID, één per
+# fase (get_endpoints, webservice, JSON decodering, DataFrame, grafiek, serialisatie), met
+# attributen zoals URL, aantal bytes, aantal events en cache-treffers. Afgeronde spans gaan
+# als JSON-regel (met de veldnamen van OTLP/JSON) naar de console of naar TRACE_FILE, zonder
+# externe collector. Zonder tracing maakt start_span geen span aan
+_active_span = contextvars.ContextVar("active_span", default=None)
+_trace_export_lock = threading.Lock()
+_trace_file = None
+
+class Span:
+    def __init__(self, name, parent=None, attributes=None):
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.error = None
+    
+    @contextmanager
+    def activate(self):
+        token = _active_span.set(self)
+        try:
+            yield self
+        finally:
+            _active_span.reset(token)
+    
+    def end(self, error=None):
+        self.end_time = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        export_span(self)
+    
+    def to_dict(self):
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": "SPAN_KIND_INTERNAL",
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time),
+            "durationMs": round((self.end_time - self.start_time) / 1e6, 3),
+            "attributes": self.attributes,
+            "status": {"code": "STATUS_CODE_ERROR", "message": self.error} if self.error else {"code": "STATUS_CODE_OK"}
+        }
+
+def export_span(span):
+    global _trace_file
+    line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+    with _trace_export_lock:
+        if TRACING == "console":
+            print(line)
+            return
+        try:
+            if _trace_file is None:
+                _trace_file = open(TRACE_FILE, "a", encoding="utf-8", buffering=1)
+            _trace_file.write(line + "\n")
+        except OSError as e:
+            print(f"Fout bij het wegschrijven van span {span.name}: {str(e)}")
+
+# Nieuwe span als kind van de actieve span (of als begin van een nieuwe trace)
+def start_span(name, attributes=None):
+    if not TRACING_ENABLED:
+        return None
+    return Span(name, _active_span.get(), attributes)
+
+@contextmanager
+def trace_span(name, attributes=None):
+    span = start_span(name, attributes)
+    if span is None:
+        yield None
+        return
+    
+    error = None
+    with span.activate():
+        try:
+            yield span
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            span.end(error)
+
+# Voeg attributen toe aan de actieve span, bijvoorbeeld zodra het aantal bytes bekend is
+def set_span_attributes(attributes):
+    span = _active_span.get()
+    if span is not None:
+        span.attributes.update(attributes)
+
+# Activeer een profiel en een span (elk optioneel) in de huidige thread
+@contextmanager
+def observe(profile, span):
+    with profile.activate() if profile is not None else nullcontext():
+        with span.activate() if span is not None else nullcontext():
+            yield
+
+# Meet de tijd van een fase voor het actieve profiel en legt de fase vast als span van de
+# actieve trace; zonder actief profiel en zonder tracing kost dit vrijwel niets
+@contextmanager
+def profile_stage(stage, attributes=None):
+    profile = _active_profile.get()
+    if profile is None and not TRACING_ENABLED:
+        yield
+        return
+    
+    with trace_span(stage, attributes):
+        if profile is None:
+            yield
+            return
+        
+        profile.attach_thread()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            profile.add_stage(stage, time.perf_counter() - started)
+            profile.detach_thread()
+
+# Meet de serialisatie van de uitvoer naar de browser door dezelfde postprocess-stap van
+# de Gradio componenten uit te voeren. Dit gebeurt alleen tijdens profilering of tracing
+def serialize_outputs(outputs):
+    if not isinstance(outputs, tuple):
+        outputs = (outputs,)
+    with profile_stage("serialisatie (Gradio)", {"gradio.outputs": len(outputs)}):
+        for output in outputs:
+            if isinstance(output, pd.DataFrame):
+                gr.DataFrame().postprocess(output)
+            elif isinstance(output, go.Figure):
+                gr.Plot().postprocess(output)
+
+# Decorator die een UI functie (ook generators) profileert als profilering is ingeschakeld
+# en als trace vastlegt als tracing aan staat
+def profiled(function):
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            if not _profiling_enabled.is_set() and not TRACING_ENABLED:
+                yield from function(*args, **kwargs)
+                return
+            
+            profile = start_profile(function.__name__) if _profiling_enabled.is_set() else None
+            span = start_span(function.__name__)
+            generator = function(*args, **kwargs)
+            outputs = None
+            error = None
+            try:
+                while True:
+                    # Elke stap van de generator kan in een andere thread draaien
+                    with observe(profile, span):
+                        try:
+                            outputs = next(generator)
+                        except StopIteration:
+                            break
+                    yield outputs
+                if outputs is not None:
+                    with observe(profile, span):
+                        serialize_outputs(outputs)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                generator.close()
+                if profile is not None:
+                    finish_profile(profile)
+                if span is not None:
+                    span.end(error)
+        return generator_wrapper
+    
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _profiling_enabled.is_set() and not TRACING_ENABLED:
+            return function(*args, **kwargs)
+        
+        profile = start_profile(function.__name__) if _profiling_enabled.is_set() else None
+        span = start_span(function.__name__)
+        error = None
+        try:
+            with observe(profile, span):
+                outputs = function(*args, **kwargs)
+                serialize_outputs(outputs)
+            return outputs
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if profile is not None:
+                finish_profile(profile)
+            if span is not None:
+                span.end(error)
+    return wrapper
+
+# Decorator voor REST endpoints: elk verzoek wordt een trace, met de trace-ID in de
+# header X-Trace-Id. Zonder tracing blijft het endpoint ongewijzigd
+def traced(function):
+    if not TRACING_ENABLED:
+        return function
+    
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with trace_span(function.__name__) as span:
+            response = function(*args, **kwargs)
+            if isinstance(response, Response):
+                span.attributes["http.response.status_code"] = response.status_code
+                response.headers["X-Trace-Id"] = span.trace_id
+            return response
+    return wrapper
+
 # Functie om de juiste endpoints te bepalen voor de gegeven API URL
 def get_endpoints(api_url):
-    # Verwijder eventuele slash aan het einde
-    if api_url.endswith('/'):
-        api_url = api_url[:-1]
-    
-    # Controleer of dit een bekende basis URL is
-    for base_url, endpoints in API_ENDPOINT_MAPPINGS.items():
-        if api_url.startswith(base_url):
+    with trace_span("get_endpoints", {"url.full": api_url}):
+        # Verwijder eventuele slash aan het einde
+        if api_url.endswith('/'):
+            api_url = api_url[:-1]
+        
+        # Controleer of dit een bekende basis URL is
+        for base_url, endpoints in API_ENDPOINT_MAPPINGS.items():
+            if api_url.startswith(base_url):
+                return {
+                    "base_url": base_url,
+                    "rest_endpoint": endpoints["rest_endpoint"],
+                    "locations_endpoint": endpoints["locations_endpoint"],
+                    "parameters_endpoint": endpoints["parameters_endpoint"],
+                    "timeseries_endpoint": endpoints["timeseries_endpoint"]
+                }
+        
+        # Als het geen bekende URL is, probeer dan de standaard patronen
+        if "/rest/fewspiservice/v1" in api_url:
+            base_url = api_url.split("/rest/fewspiservice/v1")[0]
             return {
                 "base_url": base_url,
-                "rest_endpoint": endpoints["rest_endpoint"],
-                "locations_endpoint": endpoints["locations_endpoint"],
-                "parameters_endpoint": endpoints["parameters_endpoint"],
-                "timeseries_endpoint": endpoints["timeseries_endpoint"]
+                "rest_endpoint": "/rest/fewspiservice/v1",
+                "locations_endpoint": "/rest/fewspiservice/v1/locations",
+                "parameters_endpoint": "/rest/fewspiservice/v1/parameters",
+                "timeseries_endpoint": "/rest/fewspiservice/v1/timeseries"
             }
-    
-    # Als het geen bekende URL is, probeer dan de standaard patronen
-    if "/rest/fewspiservice/v1" in api_url:
-        base_url = api_url.split("/rest/fewspiservice/v1")[0]
+        
+        # Als laatste optie, neem aan dat de gegeven URL de basis URL is
         return {
-            "base_url": base_url,
+            "base_url": api_url,
             "rest_endpoint": "/rest/fewspiservice/v1",
             "locations_endpoint": "/rest/fewspiservice/v1/locations",
             "parameters_endpoint": "/rest/fewspiservice/v1/parameters",
             "timeseries_endpoint": "/rest/fewspiservice/v1/timeseries"
         }
+
+# Haal een URL op en decodeer de JSON-respons. De respons wordt in blokken gelezen,
+# zodat het downloaden afgebroken kan worden zodra cancel_event wordt gezet
+def http_get_json(url, params=None, cancel_event=None, max_bytes=None):
+    record_metric("upstream_requests")
+    with profile_stage("webservice", {"url.full": url, "http.request.method": "GET", "fews.http_mode": HTTP_MODE}):
+        if HTTP_MODE == "replay":
+            body = replay_response(url, params, cancel_event)
+        else:
+            body = download_response(url, params, cancel_event, max_bytes)
+        if max_bytes is not None and len(body) > max_bytes:
+            record_metric("oversized_responses")
+            raise ResponseTooLarge(f"Respons groter dan {max_bytes / (1024 * 1024):.0f} MB; verklein de selectie of de periode")
+        record_metric("upstream_bytes", len(body))
+        set_span_attributes({"http.response.body.size": len(body)})
+        if HTTP_MODE == "record":
+            record_response(url, params, body)
     
-    # Als laatste optie, neem aan dat de gegeven URL de basis URL is
-    return {
-        "base_url": api_url,
-        "rest_endpoint": "/rest/fewspiservice/v1",
-        "locations_endpoint": "/rest/fewspiservice/v1/locations",
-        "parameters_endpoint": "/rest/fewspiservice/v1/parameters",
-        "timeseries_endpoint": "/rest/fewspiservice/v1/timeseries"
-    }
+    with profile_stage("JSON decodering", {"http.response.body.size": len(body)}):
+        return json.loads(body)
+
+def download_response(url, params=None, cancel_event=None, max_bytes=None):
+    with requests.get(url, params=params, stream=True) as response:
+        print(f"Status code: {response.status_code}")
+        set_span_attributes({"http.response.status_code": response.status_code})
+        response.raise_for_status()
+        
+        body = bytearray()
+        for block in response.iter_content(chunk_size=HTTP_CHUNK_SIZE):
+            if cancel_event is not None and cancel_event.is_set():
+                record_metric("cancelled_requests")
+                record_metric("cancelled_bytes", len(body))
+                raise QueryCancelled()
+            body.extend(block)
+            # Stop al tijdens het downloaden zodra de respons te groot wordt
+            if max_bytes is not None and len(body) > max_bytes:
+                break
+        return body
+
+# Archief van opgenomen responses. De respons zelf wordt gecomprimeerd opgeslagen onder de
+# hash van de inhoud (blobs/), zodat gelijke responses één keer op schijf staan; per verzoek
+# verwijst een klein indexbestand (requests/) naar de hash van de respons
+def request_key(url, params=None):
+    key = json.dumps([url, sorted((params or {}).items())])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except OSError:
+        os.unlink(temp_path)
+        raise
+
+def record_response(url, params, body):
+    content_hash = hashlib.sha256(body).hexdigest()
+    blob_path = os.path.join(HTTP_ARCHIVE_DIR, "blobs", f"{content_hash}.json.gz")
+    try:
+        if not os.path.exists(blob_path):
+            write_atomic(blob_path, gzip.compress(bytes(body)))
+        entry = {"url": url, "params": params, "content": content_hash, "recorded": time.time()}
+        write_atomic(os.path.join(HTTP_ARCHIVE_DIR, "requests", f"{request_key(url, params)}.json"), json.dumps(entry).encode())
+    except OSError as e:
+        print(f"Fout bij het opnemen van de respons: {str(e)}")
+        return
+    record_metric("recorded_responses")
+
+def replay_response(url, params=None, cancel_event=None):
+    try:
+        with open(os.path.join(HTTP_ARCHIVE_DIR, "requests", f"{request_key(url, params)}.json")) as f:
+            entry = json.load(f)
+        with gzip.open(os.path.join(HTTP_ARCHIVE_DIR, "blobs", f"{entry['content']}.json.gz")) as f:
+            body = f.read()
+    except (OSError, KeyError, ValueError):
+        raise NotRecorded(f"Geen opname gevonden voor dit verzoek in {HTTP_ARCHIVE_DIR}")
+    
+    # Gesimuleerde vertraging van de webservice; een annulering onderbreekt het wachten
+    if REPLAY_LATENCY_MS > 0 and cancel_event is not None:
+        cancel_event.wait(REPLAY_LATENCY_MS / 1000)
+    elif REPLAY_LATENCY_MS > 0:
+        time.sleep(REPLAY_LATENCY_MS / 1000)
+    if cancel_event is not None and cancel_event.is_set():
+        record_metric("cancelled_requests")
+        raise QueryCancelled()
+    
+    print("Status code: 200 (opname)")
+    record_metric("replayed_responses")
+    return body
 
 # Functies voor het ophalen van data
 def get_locations(api_url):
@@ -82,20 +777,12 @@ def get_locations(api_url):
         endpoints = get_endpoints(api_url)
         url = f"{endpoints['base_url']}{endpoints['locations_endpoint']}?documentFormat=PI_JSON"
         print(f"Request URL: {url}")
-        response = requests.get(url)
-        
-        # Debug informatie
-        print(f"Status code: {response.status_code}")
-        print(f"Response headers: {response.headers}")
-        print(f"Response tekst: {response.text[:1000]}...") # Eerste 1000 tekens
-        
-        response.raise_for_status()
-        return response.json()
+        return http_get_json(url)
     except requests.exceptions.RequestException as e:
         print(f"Request fout: {str(e)}")
         return {"error": f"Request fout: {str(e)}"}
     except json.JSONDecodeError as e:
-        print(f"JSON decode fout: {str(e)}, response: {response.text[:500]}...")
+        print(f"JSON decode fout: {str(e)}")
         return {"error": f"JSON decodering mislukt: {str(e)}"}
     except Exception as e:
         print(f"Algemene fout: {str(e)}")
@@ -106,11 +793,124 @@ def get_parameters(api_url):
         endpoints = get_endpoints(api_url)
         url = f"{endpoints['base_url']}{endpoints['parameters_endpoint']}?documentFormat=PI_JSON"
         print(f"Request URL: {url}")
-        response = requests.get(url)
-        print(f"Status code: {response.status_code}")
-        
-        response.raise_for_status()
-        return response.json()
+        return http_get_json(url)
+    except requests.exceptions.RequestException as e:
+        print(f"Request fout: {str(e)}")
+        return {"error": f"Request fout: {str(e)}"}
+    except json.JSONDecodeError as e:
+        print(f"JSON decode fout: {str(e)}")
+        return {"error": f"JSON decodering mislukt: {str(e)}"}
+    except Exception as e:
+        print(f"Algemene fout: {str(e)}")
+        return {"error": str(e)}
+
+# Filters van de webservice (een boom van locatiegroepen) en de locaties van één filter
+def get_filters(api_url):
+    try:
+        endpoints = get_endpoints(api_url)
+        url = f"{endpoints['base_url']}{endpoints['rest_endpoint']}/filters?documentFormat=PI_JSON"
+        print(f"Request URL: {url}")
+        return http_get_json(url)
+    except requests.exceptions.RequestException as e:
+        print(f"Request fout: {str(e)}")
+        return {"error": f"Request fout: {str(e)}"}
+    except json.JSONDecodeError as e:
+        print(f"JSON decode fout: {str(e)}")
+        return {"error": f"JSON decodering mislukt: {str(e)}"}
+    except Exception as e:
+        print(f"Algemene fout: {str(e)}")
+        return {"error": str(e)}
+
+def get_filter_locations(api_url, filter_id):
+    try:
+        endpoints = get_endpoints(api_url)
+        url = f"{endpoints['base_url']}{endpoints['locations_endpoint']}"
+        print(f"Request URL: {url} (filter {filter_id})")
+        return http_get_json(url, params={"filterId": filter_id, "documentFormat": "PI_JSON"})
+    except requests.exceptions.RequestException as e:
+        print(f"Request fout: {str(e)}")
+        return {"error": f"Request fout: {str(e)}"}
+    except json.JSONDecodeError as e:
+        print(f"JSON decode fout: {str(e)}")
+        return {"error": f"JSON decodering mislukt: {str(e)}"}
+    except Exception as e:
+        print(f"Algemene fout: {str(e)}")
+        return {"error": str(e)}
+
+# Verdeel IDs in groepen waarvan de komma-gescheiden lengte binnen het budget blijft
+def batch_ids(ids, budget):
+    batches = []
+    batch = []
+    length = 0
+    for id_ in ids:
+        if batch and length + 1 + len(id_) > budget:
+            batches.append(batch)
+            batch = []
+            length = 0
+        length += len(id_) + (1 if batch else 0)
+        batch.append(id_)
+    if batch:
+        batches.append(batch)
+    return batches
+
+# Combinaties van groepen locaties en parameters die elk binnen MAX_QUERY_IDS_LENGTH passen.
+# Parameters krijgen hoogstens de helft van het budget, de locaties de rest
+def query_id_batches(location_ids, parameter_ids):
+    if len(",".join(location_ids)) + len(",".join(parameter_ids)) <= MAX_QUERY_IDS_LENGTH:
+        return [(location_ids, parameter_ids)]
+    
+    parameter_batches = batch_ids(parameter_ids, min(len(",".join(parameter_ids)), MAX_QUERY_IDS_LENGTH // 2))
+    location_budget = MAX_QUERY_IDS_LENGTH - max(len(",".join(batch)) for batch in parameter_batches)
+    location_batches = batch_ids(location_ids, location_budget) or [[]]
+    return [(locations, parameters) for locations in location_batches for parameters in parameter_batches]
+
+# Voer een tijdseries-verzoek uit in zo min mogelijk verzoeken waarvan de query string binnen
+# MAX_QUERY_IDS_LENGTH blijft, en voeg de lijsten onder merge_key samen. Zonder locatie-IDs
+# (bij een filterId) wordt alleen op parameters verdeeld
+def http_get_json_batched(url, params, location_ids, parameter_ids, merge_key, cancel_event=None, max_bytes=None):
+    merged = None
+    for batch_locations, batch_parameters in query_id_batches(location_ids, parameter_ids):
+        ids = {"locationIds": ",".join(batch_locations)} if batch_locations else {}
+        ids["parameterIds"] = ",".join(batch_parameters)
+        data = http_get_json(url, params={**ids, **params}, cancel_event=cancel_event, max_bytes=max_bytes)
+        if merged is None:
+            merged = data
+        else:
+            merged.setdefault(merge_key, []).extend(data.get(merge_key, []))
+    return merged
+
+def get_timeseries(api_url, location_ids, parameter_ids, start_date=None, end_date=None, cancel_event=None, filter_id=None):
+    # Converteer enkele strings naar lijsten indien nodig
+    if isinstance(location_ids, str):
+        location_ids = [location_ids.strip()]
+    if isinstance(parameter_ids, str):
+        parameter_ids = [parameter_ids.strip()]
+    
+    # Met een filterId levert de webservice alle locaties van het filter in één verzoek
+    params = {"filterId": filter_id} if filter_id else {}
+    params.update({
+        "documentFormat": "DD_JSON",
+        "omitMissing": "true"
+    })
+    
+    if start_date:
+        params["startTime"] = start_date
+    if end_date:
+        params["endTime"] = end_date
+    
+    try:
+        endpoints = get_endpoints(api_url)
+        request_url = f"{endpoints['base_url']}{endpoints['timeseries_endpoint']}"
+        print(f"Request URL: {request_url}")
+        print(f"Request parameters: {params} ({len(location_ids)} locaties, {len(parameter_ids)} parameters)")
+        return http_get_json_batched(request_url, params, [] if filter_id else location_ids, parameter_ids, "results",
+                                     cancel_event=cancel_event, max_bytes=MAX_RESPONSE_MB * 1024 * 1024)
+    except QueryCancelled:
+        print(f"Verzoek geannuleerd: {request_url}")
+        return {"error": "Verzoek geannuleerd"}
+    except ResponseTooLarge as e:
+        print(f"Respons te groot: {request_url}")
+        return {"error": str(e)}
     except requests.exceptions.RequestException as e:
         print(f"Request fout: {str(e)}")
         return {"error": f"Request fout: {str(e)}"}
@@ -121,273 +921,2524 @@ def get_parameters(api_url):
         print(f"Algemene fout: {str(e)}")
         return {"error": str(e)}
 
-def get_timeseries(api_url, location_ids, parameter_ids, start_date=None, end_date=None):
-    # Converteer enkele strings naar lijsten indien nodig
-    if isinstance(location_ids, str):
-        location_ids = [location_ids.strip()]
-    if isinstance(parameter_ids, str):
-        parameter_ids = [parameter_ids.strip()]
+# Vraag alleen de headers van tijdseries op (zonder events), om te bepalen welke
+# locatie-parameter combinaties bestaan. Met show_statistics bevatten de headers ook het
+# aantal waarden en de eerste en laatste tijdstap in de periode
+def get_timeseries_headers(api_url, location_ids, parameter_ids, start_date=None, end_date=None, show_statistics=False):
+    params = {
+        "documentFormat": "PI_JSON",
+        "onlyHeaders": "true"
+    }
+    
+    if start_date:
+        params["startTime"] = start_date
+    if end_date:
+        params["endTime"] = end_date
+    if show_statistics:
+        params["showStatistics"] = "true"
+    
+    try:
+        endpoints = get_endpoints(api_url)
+        request_url = f"{endpoints['base_url']}{endpoints['timeseries_endpoint']}"
+        print(f"Request URL: {request_url} (alleen headers, {len(location_ids)} locaties)")
+        return http_get_json_batched(request_url, params, location_ids, parameter_ids, "timeSeries")
+    except requests.exceptions.RequestException as e:
+        print(f"Request fout: {str(e)}")
+        return {"error": f"Request fout: {str(e)}"}
+    except json.JSONDecodeError as e:
+        print(f"JSON decode fout: {str(e)}")
+        return {"error": f"JSON decodering mislukt: {str(e)}"}
+    except Exception as e:
+        print(f"Algemene fout: {str(e)}")
+        return {"error": str(e)}
+
+# Cache voor locatie- en parametercatalogi, gedeeld door de UI en de REST API
+_catalog_cache = {}
+_catalog_cache_lock = threading.Lock()
+
+# Sleutel waarmee gegevens per webservice worden bijgehouden, ongeacht het URL-formaat
+def endpoint_key(api_url):
+    endpoints = get_endpoints(api_url)
+    return f"{endpoints['base_url']}{endpoints['rest_endpoint']}"
+
+# Per catalogus hoogstens één lopende download; wie tegelijk dezelfde catalogus nodig heeft
+# (bijvoorbeeld tijdens het vooraf ophalen) wacht op die download
+_catalog_fetch_locks = {}
+
+def catalog_fetch_lock(key):
+    with _catalog_cache_lock:
+        return _catalog_fetch_locks.setdefault(key, threading.Lock())
+
+def get_cached_catalog(kind, api_url, fetch_function):
+    key = (kind, endpoint_key(api_url))
+    
+    with catalog_fetch_lock(key):
+        with _catalog_cache_lock:
+            entry = _catalog_cache.get(key)
+        if entry and time.time() - entry[0] < CATALOG_CACHE_TTL:
+            return entry[1]
+        return fetch_catalog(key, api_url, fetch_function)
+
+def refresh_cached_catalog(kind, api_url, fetch_function):
+    key = (kind, endpoint_key(api_url))
+    with catalog_fetch_lock(key):
+        return fetch_catalog(key, api_url, fetch_function)
+
+def fetch_catalog(key, api_url, fetch_function):
+    data = fetch_function(api_url)
+    # Fouten niet cachen, zodat een volgende poging opnieuw de webservice bevraagt
+    if "error" not in data:
+        with _catalog_cache_lock:
+            _catalog_cache[key] = (time.time(), data)
+        account_memory("catalogi", key, object_memory(data))
+        expire_memory()
+    return data
+
+# Vooraf ophalen van de catalogi van DEFAULT_API_URL en de bekende webservices in
+# API_ENDPOINT_MAPPINGS. Dit gebeurt op de achtergrond, zodat het opstarten niet wacht
+def warmup_api_urls():
+    api_urls = {}
+    for api_url in [DEFAULT_API_URL] + [base_url + endpoints["rest_endpoint"] for base_url, endpoints in API_ENDPOINT_MAPPINGS.items()]:
+        api_urls.setdefault(endpoint_key(api_url), api_url)
+    return list(api_urls.values())
+
+def start_catalog_warmup():
+    if CATALOG_WARMUP_INTERVAL <= 0:
+        return
+    threading.Thread(target=catalog_warmup_worker, daemon=True).start()
+
+def catalog_warmup_worker():
+    while True:
+        for api_url in warmup_api_urls():
+            for kind, fetch_function in (("locations", load_location_catalog), ("parameters", get_parameters)):
+                try:
+                    with trace_span("catalogus vooraf ophalen", {"url.full": api_url, "fews.catalog": kind}):
+                        data = refresh_cached_catalog(kind, api_url, fetch_function)
+                    if "error" in data:
+                        print(f"Vooraf ophalen van {kind} voor {api_url} mislukt: {data['error']}")
+                except Exception as e:
+                    print(f"Fout bij het vooraf ophalen van {kind} voor {api_url}: {str(e)}")
+        time.sleep(CATALOG_WARMUP_INTERVAL)
+
+# Lopende tijdseries-opvragingen per sessie. Een nieuwe opvraging of de knop "Annuleren"
+# zet het cancel_event van de vorige, waardoor de bijbehorende verzoeken en verwerking stoppen
+_session_queries = {}
+_session_queries_lock = threading.Lock()
+
+def start_session_query(session_id):
+    cancel_event = threading.Event()
+    if session_id is None:
+        return cancel_event
+    
+    with _session_queries_lock:
+        previous = _session_queries.get(session_id)
+        _session_queries[session_id] = cancel_event
+    if previous is not None and not previous.is_set():
+        previous.set()
+        record_metric("superseded_queries")
+    return cancel_event
+
+def finish_session_query(session_id, cancel_event):
+    with _session_queries_lock:
+        if _session_queries.get(session_id) is cancel_event:
+            del _session_queries[session_id]
+
+def cancel_session_query(session_id):
+    with _session_queries_lock:
+        cancel_event = _session_queries.pop(session_id, None)
+    if cancel_event is None:
+        return False
+    cancel_event.set()
+    return True
+
+# Zet een datum (YYYY-MM-DD) om naar het tijdformaat van de FEWS webservice
+def format_date(date_str):
+    return datetime.strptime(date_str, "%Y-%m-%d").strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# Liep de periode op het moment at (standaard nu, in seconden sinds 1970) nog door, doordat er
+# geen einddatum is of de einddatum later ligt?
+def period_is_open(end_date, at=None):
+    moment = pd.Timestamp(time.time() if at is None else at, unit="s", tz="UTC")
+    return not end_date or end_date > format_timestamp(moment)
+
+# Normaliseer een ingevoerde URL naar de URL van de REST service
+def normalize_api_url(api_url):
+    if not api_url:
+        api_url = DEFAULT_API_URL
+    
+    # Verwijder eventuele slash aan het einde
+    if api_url.endswith('/'):
+        api_url = api_url[:-1]
+    
+    # Poging om te veranderen naar een REST endpoint als het nog niet is gespecificeerd
+    if not ("/rest/fewspiservice/v1" in api_url):
+        endpoints = get_endpoints(api_url)
+        api_url = f"{endpoints['base_url']}{endpoints['rest_endpoint']}"
+    
+    return api_url
+
+# Verwerking van de webservice-responses naar DataFrames
+# Velden van een locatie die als kolommen in de locatietabel komen
+LOCATION_FIELDS = ["locationId", "description", "shortName", "lat", "lon", "x", "y", "z"]
+
+# Zet de PI_JSON formaat van locaties om naar een locatietabel (één rij per locatie, met
+# een kolom attr_<id> per attribuut) en een omgekeerde index van (attribuut-id, waarde)
+# naar locatie-IDs, zodat "alle locaties waar attribuut X = Y" een enkele opzoeking is
+def parse_location_catalog(data):
+    records = data.get("locations") or []
+    if not records:
+        return {"locations": None, "attribute_index": {}}
+    
+    base = pd.DataFrame.from_records(records, columns=LOCATION_FIELDS)
+    locations_df = pd.DataFrame({
+        "id": base["locationId"].fillna("Onbekend"),
+        "name": base["description"].fillna(base["shortName"]).fillna("Onbekend"),
+        "shortName": base["shortName"].fillna(""),
+        "lat": base["lat"].fillna(""),
+        "lon": base["lon"].fillna(""),
+        "x": base["x"].fillna(""),
+        "y": base["y"].fillna(""),
+        "z": base["z"].fillna("")
+    })
+    
+    # Attributen in één keer plat slaan tot (rij, attribuut-id, waarde)
+    attributes = pd.DataFrame(
+        [
+            (row, attr["id"], attr["text"])
+            for row, location in enumerate(records)
+            for attr in location.get("attributes") or ()
+            if "id" in attr and "text" in attr
+        ],
+        columns=["row", "attr_id", "value"]
+    )
+    if attributes.empty:
+        return {"locations": locations_df, "attribute_index": {}}
+    
+    # Attribuutkolommen vullen via een matrix in plaats van een dict per locatie
+    rows = attributes["row"].to_numpy()
+    codes, attr_ids = pd.factorize(attributes["attr_id"])
+    matrix = np.full((len(locations_df), len(attr_ids)), np.nan, dtype=object)
+    matrix[rows, codes] = attributes["value"].to_numpy()
+    attr_columns = pd.DataFrame(matrix, columns=[f"attr_{attr_id}" for attr_id in attr_ids], index=locations_df.index)
+    locations_df = pd.concat([locations_df, attr_columns], axis=1)
+    
+    location_ids = locations_df["id"].to_numpy()[rows]
+    attribute_index = {
+        key: pd.unique(location_ids[positions]).tolist()
+        for key, positions in attributes.groupby(["attr_id", "value"], sort=False).indices.items()
+    }
+    return {"locations": locations_df, "attribute_index": attribute_index}
+
+def load_location_catalog(api_url):
+    data = get_locations(api_url)
+    if "error" in data:
+        return data
+    with profile_stage("DataFrame"):
+        return parse_location_catalog(data)
+
+def find_locations_by_attribute(catalog, attr_id, value):
+    return catalog["attribute_index"].get((attr_id, value), [])
+
+# Filters als platte lijst (id, naam), inclusief onderliggende filters
+def parse_filters(data):
+    filters = []
+    pending = list(data.get("filters", []))
+    while pending:
+        item = pending.pop(0)
+        if item.get("id"):
+            filters.append((item["id"], item.get("name") or item["id"]))
+        pending.extend(item.get("child", []) or item.get("children", []))
+    return filters
+
+def load_filters(api_url):
+    data = get_filters(api_url)
+    if "error" in data:
+        return data
+    return {"filters": parse_filters(data)}
+
+# Locaties van een filter, lokaal uitgeklapt (gecachet als catalogus "filter:<id>")
+def load_filter_locations(api_url, filter_id):
+    data = get_filter_locations(api_url, filter_id)
+    if "error" in data:
+        return data
+    return {"location_ids": [location["locationId"] for location in data.get("locations", []) if "locationId" in location]}
+
+def expand_filter(api_url, filter_id):
+    return get_cached_catalog(f"filter:{filter_id}", api_url, functools.partial(load_filter_locations, filter_id=filter_id))
+
+# Filters die al zijn uitgeklapt en waarvan alle locaties in de selectie zitten. Ze worden
+# met één filterId-verzoek opgehaald in plaats van met lange lijsten locatie-IDs. Grootste
+# filters eerst, zonder overlap; dit raadpleegt alleen de cache
+def match_filters(api_url, location_ids):
+    key = endpoint_key(api_url)
+    now = time.time()
+    with _catalog_cache_lock:
+        candidates = [
+            (kind.split(":", 1)[1], data["location_ids"])
+            for (kind, endpoint), (stored, data) in _catalog_cache.items()
+            if endpoint == key and kind.startswith("filter:") and now - stored < CATALOG_CACHE_TTL
+        ]
+    
+    remaining = set(location_ids)
+    matches = []
+    for filter_id, filter_locations in sorted(candidates, key=lambda candidate: -len(candidate[1])):
+        if len(filter_locations) > 1 and remaining.issuperset(filter_locations):
+            matches.append((filter_id, sorted(filter_locations)))
+            remaining.difference_update(filter_locations)
+    return matches
+
+def parameters_to_dataframe(data):
+    # Verwerk de PI_JSON formaat van parameters
+    parameters = []
+    
+    # Controleer of we het verwachte formaat hebben
+    if "timeSeriesParameters" in data:
+        for parameter in data.get("timeSeriesParameters", []):
+            # Alle beschikbare velden uit de parameter toevoegen
+            param_data = {
+                "id": parameter.get("id", "Onbekend"),
+                "name": parameter.get("name", "Onbekend"),
+                "shortName": parameter.get("shortName", ""),
+                "unit": parameter.get("unit", ""),
+                "displayUnit": parameter.get("displayUnit", ""),
+                "parameterType": parameter.get("parameterType", ""),
+                "parameterGroup": parameter.get("parameterGroup", ""),
+                "parameterGroupName": parameter.get("parameterGroupName", ""),
+                "usesDatum": parameter.get("usesDatum", "")
+            }
+            parameters.append(param_data)
+    
+    if not parameters:
+        return None
+    
+    return pd.DataFrame(parameters)
+
+# Kolommen van een genormaliseerd tijdseries-resultaat
+TIMESERIES_COLUMNS = ["locationId", "parameterId", "member", "timestamp", "value", "series_id"]
+# Kolommen die uit de schijfcache categorisch terugkomen
+CATEGORICAL_COLUMNS = ["locationId", "parameterId", "member", "series_id"]
+
+# Velden waarin FEWS bij een ensemble het lid van een reeks aangeeft. Elk lid komt als aparte
+# reeks binnen; deterministische reeksen hebben geen lid
+ENSEMBLE_MEMBER_FIELDS = ["ensembleMemberId", "ensembleMember", "ensembleMemberIndex", "realization"]
+
+def ensemble_member(result):
+    for source in (result, result.get("properties", {})):
+        for field in ENSEMBLE_MEMBER_FIELDS:
+            if source.get(field) is not None:
+                return str(source[field])
+    return None
+
+def timeseries_to_dataframe(data):
+    # Verwerk de DD_JSON formaat van tijdseries
+    all_series = []
+    
+    # Controleer of we het verwachte formaat hebben
+    if "results" in data:
+        for result in data.get("results", []):
+            if "events" not in result:
+                continue
+                
+            # Haal locatie en parameter informatie op
+            location_id = "Onbekend"
+            parameter_id = "Onbekend"
+            
+            if "location" in result and "properties" in result["location"]:
+                location_id = result["location"]["properties"].get("locationId", "Onbekend")
+                
+            if "observationType" in result:
+                parameter_id = result["observationType"].get("parameterCode", "Onbekend")
+            
+            member = ensemble_member(result)
+            
+            # Verwerk events
+            for event in result.get("events", []):
+                all_series.append({
+                    "locationId": location_id,
+                    "parameterId": parameter_id,
+                    "member": member,
+                    "timestamp": event.get("timeStamp", ""),
+                    "value": event.get("value", None)
+                })
+    
+    if not all_series:
+        return None
+    
+    df = pd.DataFrame(all_series)
+    df["timestamp"] = pd.to_datetime(df["timestamp"])
+    df["value"] = pd.to_numeric(df["value"], errors="coerce")
+    
+    # Sorteer de data chronologisch op timestamp
+    df = df.sort_values(by="timestamp")
+    
+    # Maak een unieke legenda-identifier per combinatie van locatie en parameter
+    df["series_id"] = df["locationId"] + " - " + df["parameterId"]
+    return df
+
+# Beschikbaarheidsindex per webservice: welke locatie-parameter combinaties tijdseries
+# hebben, als bitset (één bit per parameter per locatie). Een achtergrondtaak vult de index
+# met header-verzoeken en ververst steeds de langst niet bijgewerkte locaties eerst
+_availability = {}
+# Laatste gebruik van de index per webservice (verbinden of filteren van de dropdowns)
+_availability_used = {}
+_availability_lock = threading.Lock()
+
+def start_availability_index(api_url):
+    if AVAILABILITY_REFRESH_INTERVAL <= 0:
+        return
+    
+    key = endpoint_key(api_url)
+    known = {endpoint_key(known_url) for known_url in warmup_api_urls()}
+    with _availability_lock:
+        if key in _availability:
+            _availability_used[key] = time.time()
+            return
+        if key not in known and len(set(_availability) - known) >= AVAILABILITY_MAX_ENDPOINTS:
+            print(f"Geen beschikbaarheidsindex voor {api_url}: er worden al {AVAILABILITY_MAX_ENDPOINTS} webservices bijgehouden")
+            return
+        _availability[key] = None
+        _availability_used[key] = time.time()
+    threading.Thread(target=availability_worker, args=(api_url,), daemon=True).start()
+
+def availability_worker(api_url):
+    key = endpoint_key(api_url)
+    errors = 0
+    while True:
+        try:
+            with trace_span("beschikbaarheidsindex", {"url.full": api_url}):
+                refreshed = refresh_availability_index(api_url)
+        except Exception as e:
+            print(f"Fout bij het bijwerken van de beschikbaarheidsindex: {str(e)}")
+            refreshed = False
+        
+        errors = 0 if refreshed else errors + 1
+        with _availability_lock:
+            built = _availability.get(key) is not None
+        if errors and (not built or errors >= AVAILABILITY_MAX_ERRORS):
+            print(f"Beschikbaarheidsindex voor {api_url} gestopt: webservice niet bereikbaar")
+            break
+        
+        time.sleep(AVAILABILITY_REFRESH_INTERVAL)
+        with _availability_lock:
+            idle = time.time() - _availability_used.get(key, 0)
+        if idle > AVAILABILITY_IDLE_SECONDS:
+            print(f"Beschikbaarheidsindex voor {api_url} gestopt: niet meer gebruikt")
+            break
+    stop_availability_index(key)
+
+# Een gestopte index wordt bij het volgende verbinden opnieuw opgebouwd
+def stop_availability_index(key):
+    with _availability_lock:
+        _availability.pop(key, None)
+        _availability_used.pop(key, None)
+    release_memory("beschikbaarheid", key)
+
+# Stem de index af op de huidige catalogi; bekende combinaties blijven behouden
+def align_availability_index(index, location_ids, parameter_ids):
+    bits = np.zeros((len(location_ids), len(parameter_ids)), dtype=bool)
+    refreshed = np.zeros(len(location_ids))
+    
+    if index is not None:
+        old_location_pos = index["location_pos"]
+        old_parameter_pos = index["parameter_pos"]
+        new_rows = [i for i, location_id in enumerate(location_ids) if location_id in old_location_pos]
+        new_cols = [j for j, parameter_id in enumerate(parameter_ids) if parameter_id in old_parameter_pos]
+        old_rows = [old_location_pos[location_ids[i]] for i in new_rows]
+        old_cols = [old_parameter_pos[parameter_ids[j]] for j in new_cols]
+        old_bits = np.unpackbits(index["bits"], axis=1, count=len(index["parameter_ids"])).astype(bool)
+        bits[np.ix_(new_rows, new_cols)] = old_bits[np.ix_(old_rows, old_cols)]
+        refreshed[new_rows] = index["refreshed"][old_rows]
+    
+    return {
+        "location_ids": location_ids,
+        "location_pos": {location_id: i for i, location_id in enumerate(location_ids)},
+        "parameter_ids": parameter_ids,
+        "parameter_pos": {parameter_id: j for j, parameter_id in enumerate(parameter_ids)},
+        "bits": np.packbits(bits, axis=1),
+        "refreshed": refreshed
+    }
+
+def refresh_availability_index(api_url):
+    key = endpoint_key(api_url)
+    location_catalog = get_cached_catalog("locations", api_url, load_location_catalog)
+    parameter_data = get_cached_catalog("parameters", api_url, get_parameters)
+    if "error" in location_catalog or "error" in parameter_data or location_catalog["locations"] is None:
+        return False
+    params_df = parameters_to_dataframe(parameter_data)
+    if params_df is None:
+        return False
+    
+    location_ids = pd.unique(location_catalog["locations"]["id"]).tolist()
+    parameter_ids = pd.unique(params_df["id"]).tolist()
+    with _availability_lock:
+        index = align_availability_index(_availability.get(key), location_ids, parameter_ids)
+        _availability[key] = index
+    account_memory("beschikbaarheid", key, object_memory(index))
+    
+    # Ververs de locaties in volgorde van laatste verversing (nooit ververste locaties eerst)
+    order = np.argsort(index["refreshed"], kind="stable")
+    refreshed = len(order) == 0
+    for start in range(0, len(order), AVAILABILITY_LOCATIONS_PER_REQUEST):
+        rows = order[start:start + AVAILABILITY_LOCATIONS_PER_REQUEST]
+        batch = [location_ids[row] for row in rows]
+        data = get_timeseries_headers(api_url, batch, parameter_ids)
+        if "error" in data:
+            continue
+        refreshed = True
+        
+        row_bits = np.zeros((len(rows), len(parameter_ids)), dtype=bool)
+        batch_pos = {location_id: i for i, location_id in enumerate(batch)}
+        for series in data.get("timeSeries", []):
+            header = series.get("header", {})
+            row = batch_pos.get(header.get("locationId"))
+            col = index["parameter_pos"].get(header.get("parameterId"))
+            if row is not None and col is not None:
+                row_bits[row, col] = True
+        
+        # Werk de index per groep bij, zodat de dropdowns direct van gedeeltelijke resultaten profiteren
+        with _availability_lock:
+            index["bits"][rows] = np.packbits(row_bits, axis=1)
+            index["refreshed"][rows] = time.time()
+    return refreshed
+
+# Parameters met tijdseries voor tenminste één van de locaties; None zolang (een deel van)
+# deze locaties nog niet in de index is opgenomen
+def available_parameters(api_url, location_ids):
+    with _availability_lock:
+        index = _availability.get(endpoint_key(api_url))
+        if index is not None:
+            _availability_used[endpoint_key(api_url)] = time.time()
+        if index is None or not location_ids:
+            return None
+        rows = [index["location_pos"].get(location_id) for location_id in location_ids]
+        if None in rows or not index["refreshed"][rows].all():
+            return None
+        bits = np.unpackbits(index["bits"][rows], axis=1, count=len(index["parameter_ids"]))
+    return [index["parameter_ids"][j] for j in np.flatnonzero(bits.any(axis=0))]
+
+# Locaties met tijdseries voor tenminste één van de parameters; None zolang de index
+# nog niet volledig is opgebouwd
+def available_locations(api_url, parameter_ids):
+    with _availability_lock:
+        index = _availability.get(endpoint_key(api_url))
+        if index is not None:
+            _availability_used[endpoint_key(api_url)] = time.time()
+        if index is None or not parameter_ids or not index["refreshed"].all():
+            return None
+        cols = [index["parameter_pos"][parameter_id] for parameter_id in parameter_ids if parameter_id in index["parameter_pos"]]
+        bits = np.unpackbits(index["bits"], axis=1, count=len(index["parameter_ids"]))
+    return [index["location_ids"][i] for i in np.flatnonzero(bits[:, cols].any(axis=1))]
+
+# Schijfcache van verwerkte tijdseries. Per deelverzoek worden timestamps, waarden en
+# reekscodes als losse .npy bestanden opgeslagen, zodat een eerder opgehaald resultaat met
+# een memory map geopend kan worden in plaats van opnieuw JSON te decoderen
+_series_cache_lock = threading.Lock()
+
+def series_cache_path(api_url, sub_request):
+    key = json.dumps([endpoint_key(api_url), sub_request], sort_keys=True)
+    return os.path.join(SERIES_CACHE_DIR, hashlib.sha256(key.encode()).hexdigest())
+
+def load_cached_series(api_url, sub_request):
+    if SERIES_CACHE_MAX_MB <= 0:
+        return None
+    
+    path = series_cache_path(api_url, sub_request)
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if time.time() - meta["stored"] > series_cache_ttl(sub_request, meta["stored"]):
+            return None
+        timestamps = np.load(os.path.join(path, "timestamps.npy"), mmap_mode="r")
+        values = np.load(os.path.join(path, "values.npy"), mmap_mode="r")
+        codes = np.load(os.path.join(path, "codes.npy"), mmap_mode="r")
+        member_codes = np.load(os.path.join(path, "member_codes.npy"), mmap_mode="r")
+        # Markeer als recent gebruikt voor de opruiming
+        os.utime(path)
+    except (OSError, ValueError, KeyError):
+        return None
+    
+    # De tekstkolommen worden categorisch op de gemapte codes opgebouwd in plaats van per rij
+    # uitgeschreven. Gesorteerde categorieën houden de volgorde van factorize(sort=True) gelijk
+    # aan die van gewone tekstkolommen; code -1 (geen lid) blijft een ontbrekende waarde
+    series = np.array(meta["series"], dtype=object).reshape(-1, 3)
+    member_map, members = pd.factorize(np.array(meta["members"], dtype=object), sort=True)
+    timestamp_index = pd.DatetimeIndex(timestamps)
+    if meta["tz"]:
+        timestamp_index = timestamp_index.tz_localize("UTC").tz_convert(meta["tz"])
+    
+    return pd.DataFrame({
+        "locationId": cached_categorical(codes, series[:, 0]),
+        "parameterId": cached_categorical(codes, series[:, 1]),
+        "member": pd.Categorical.from_codes(np.append(member_map, -1)[member_codes], members),
+        "timestamp": timestamp_index,
+        "value": values,
+        "series_id": cached_categorical(codes, series[:, 2])
+    }, copy=False)
+
+# Categorische kolom met per rij de waarde values[code]
+def cached_categorical(codes, values):
+    value_codes, categories = pd.factorize(values, sort=True)
+    return pd.Categorical.from_codes(value_codes[codes], categories)
+
+# Categorische kolommen als gewone tekstkolommen, met None voor ontbrekende waarden
+def plain_columns(df):
+    columns = [column for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)]
+    if not columns:
+        return df
+    return df.assign(**{column: df[column].astype(object).where(df[column].notna(), None) for column in columns})
+
+# Een deelverzoek dat op het moment van opslaan nog doorliep (zonder einddatum of met een
+# einddatum in de toekomst) mist de events die daarna zijn bijgekomen; het blijft daarom maar
+# OPEN_PERIOD_MAX_AGE seconden geldig
+def series_cache_ttl(sub_request, stored):
+    return OPEN_PERIOD_MAX_AGE if period_is_open(sub_request["end_date"], stored) else SERIES_CACHE_TTL
+
+def store_cached_series(api_url, sub_request, df):
+    if SERIES_CACHE_MAX_MB <= 0 or series_cache_ttl(sub_request, time.time()) <= 0:
+        return
+    
+    codes, series_ids = pd.factorize(df["series_id"])
+    first_rows = np.unique(codes, return_index=True)[1]
+    series = df[["locationId", "parameterId", "series_id"]].iloc[first_rows].values.tolist()
+    member_codes, members = pd.factorize(df["member"])
+    tz = df["timestamp"].dt.tz
+    timestamps = (df["timestamp"].dt.tz_convert("UTC").dt.tz_localize(None) if tz is not None else df["timestamp"]).to_numpy()
+    
+    path = series_cache_path(api_url, sub_request)
+    temp_path = None
+    try:
+        os.makedirs(SERIES_CACHE_DIR, exist_ok=True)
+        temp_path = tempfile.mkdtemp(prefix=".tmp-", dir=SERIES_CACHE_DIR)
+        np.save(os.path.join(temp_path, "timestamps.npy"), timestamps.astype("datetime64[ns]"))
+        np.save(os.path.join(temp_path, "values.npy"), df["value"].to_numpy(dtype=np.float64))
+        np.save(os.path.join(temp_path, "codes.npy"), codes.astype(np.int32))
+        np.save(os.path.join(temp_path, "member_codes.npy"), member_codes.astype(np.int32))
+        with open(os.path.join(temp_path, "meta.json"), "w") as f:
+            json.dump({
+                "stored": time.time(),
+                "series": series,
+                "members": members.tolist(),
+                "tz": str(tz) if tz is not None else None
+            }, f)
+        
+        # Vervang een eventuele verouderde versie in één stap
+        with _series_cache_lock:
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Fout bij het opslaan in de tijdseriescache: {str(e)}")
+        if temp_path is not None:
+            shutil.rmtree(temp_path, ignore_errors=True)
+        return
+    
+    evict_series_cache()
+
+# Verwijder de minst recent gebruikte vermeldingen tot de cache binnen SERIES_CACHE_MAX_MB past
+def evict_series_cache():
+    with _series_cache_lock:
+        entries = []
+        for entry in os.scandir(SERIES_CACHE_DIR):
+            # Sla bestanden en nog niet afgeronde vermeldingen over
+            if not entry.is_dir() or entry.name.startswith(".tmp-"):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= SERIES_CACHE_MAX_MB * 1024 * 1024:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            record_metric("series_cache_evictions")
+
+# Splits een tijdseries-verzoek op in deelverzoeken per groep locaties
+def plan_timeseries_requests(location_ids, parameter_ids, start_date=None, end_date=None, estimates=None, filters=()):
+    # Converteer enkele strings naar lijsten indien nodig
+    if isinstance(location_ids, str):
+        location_ids = [location_ids.strip()]
+    if isinstance(parameter_ids, str):
+        parameter_ids = [parameter_ids.strip()]
+    
+    # Een filter dat in zijn geheel geselecteerd is en volgens de schatting in één respons
+    # past, wordt met één filterId-verzoek opgehaald
+    sub_requests = []
+    if estimates is not None:
+        for filter_id, filter_locations in filters:
+            events = sum(estimates[location_id]["events"] for location_id in filter_locations if location_id in estimates)
+            if 0 < events <= max_events_per_request():
+                sub_requests.append({
+                    "filter_id": filter_id,
+                    "location_ids": filter_locations,
+                    "parameter_ids": parameter_ids,
+                    "start_date": start_date,
+                    "end_date": end_date
+                })
+                filtered = set(filter_locations)
+                location_ids = [location_id for location_id in location_ids if location_id not in filtered]
+    
+    if estimates is None:
+        return [
+            {
+                "location_ids": location_ids[i:i + TIMESERIES_LOCATIONS_PER_REQUEST],
+                "parameter_ids": parameter_ids,
+                "start_date": start_date,
+                "end_date": end_date
+            }
+            for i in range(0, len(location_ids), TIMESERIES_LOCATIONS_PER_REQUEST)
+        ]
+    
+    # Met een schatting per locatie: groepeer locaties tot de grens per deelverzoek is bereikt.
+    # Locaties zonder tijdseries worden overgeslagen, te grote locaties worden in de tijd opgesplitst
+    max_events = max_events_per_request()
+    batch = []
+    batch_events = 0
+    for location_id in location_ids:
+        estimate = estimates.get(location_id)
+        if estimate is None or estimate["events"] == 0:
+            continue
+        
+        if estimate["events"] > max_events:
+            sub_requests.extend(split_request_in_time(location_id, parameter_ids, start_date, end_date, estimate, max_events))
+            continue
+        
+        if batch and (batch_events + estimate["events"] > max_events or len(batch) >= TIMESERIES_LOCATIONS_PER_REQUEST):
+            sub_requests.append({"location_ids": batch, "parameter_ids": parameter_ids, "start_date": start_date, "end_date": end_date})
+            batch = []
+            batch_events = 0
+        batch.append(location_id)
+        batch_events += estimate["events"]
+    
+    if batch:
+        sub_requests.append({"location_ids": batch, "parameter_ids": parameter_ids, "start_date": start_date, "end_date": end_date})
+    return sub_requests
+
+def max_events_per_request():
+    return max(int(MAX_RESPONSE_MB * 1024 * 1024 * RESPONSE_PLANNING_FRACTION / ESTIMATED_BYTES_PER_EVENT), 1)
+
+# Splits een te grote locatie op in aaneensluitende, niet-overlappende tijdvakken
+def split_request_in_time(location_id, parameter_ids, start_date, end_date, estimate, max_events):
+    first = pd.Timestamp(start_date) if start_date else estimate["first"]
+    last = pd.Timestamp(end_date) if end_date else estimate["last"]
+    if first is None or last is None or last <= first:
+        return [{"location_ids": [location_id], "parameter_ids": parameter_ids, "start_date": start_date, "end_date": end_date}]
+    
+    windows = -(-estimate["events"] // max_events)
+    edges = pd.date_range(first, last, periods=windows + 1).floor("s")
+    return [
+        {
+            "location_ids": [location_id],
+            "parameter_ids": parameter_ids,
+            "start_date": format_timestamp(window_start),
+            # De eindtijd is inclusief; de laatste seconde van het vak hoort bij het volgende vak
+            "end_date": format_timestamp(window_end if i == windows - 1 else window_end - pd.Timedelta(seconds=1))
+        }
+        for i, (window_start, window_end) in enumerate(zip(edges[:-1], edges[1:]))
+    ]
+
+def parse_pi_time(value):
+    if not value or "date" not in value:
+        return None
+    return pd.Timestamp(f"{value['date']}T{value.get('time', '00:00:00')}", tz="UTC")
+
+# Schat het aantal events van één reeks uit de header: het aantal waarden als de webservice
+# statistieken meestuurt, anders de lengte van de periode gedeeld door de tijdstap
+def estimate_series_events(header, start_date, end_date):
+    first = parse_pi_time(header.get("firstValueTime")) or (pd.Timestamp(start_date) if start_date else parse_pi_time(header.get("startDate")))
+    last = parse_pi_time(header.get("lastValueTime")) or (pd.Timestamp(end_date) if end_date else parse_pi_time(header.get("endDate")))
+    
+    if "valueCount" in header:
+        return int(header["valueCount"]), first, last
+    
+    # Niet-equidistante reeksen worden als uurreeksen geschat
+    time_step = header.get("timeStep", {})
+    step_seconds = 3600
+    if time_step.get("unit") == "second" and time_step.get("multiplier"):
+        step_seconds = max(int(time_step["multiplier"]), 1)
+    
+    if first is None or last is None:
+        return None, first, last
+    return int((last - first).total_seconds() // step_seconds) + 1, first, last
+
+# Schat per locatie het aantal events en de periode met data, op basis van de headers
+def estimate_timeseries_size(api_url, location_ids, parameter_ids, start_date=None, end_date=None):
+    data = get_timeseries_headers(api_url, location_ids, parameter_ids, start_date, end_date, show_statistics=True)
+    if "error" in data:
+        return None
+    
+    estimates = {}
+    for series in data.get("timeSeries", []):
+        header = series.get("header", {})
+        events, first, last = estimate_series_events(header, start_date, end_date)
+        # Een onbekende omvang telt als een volledig deelverzoek
+        if events is None:
+            events = max_events_per_request()
+        
+        estimate = estimates.setdefault(header.get("locationId"), {"events": 0, "first": None, "last": None})
+        estimate["events"] += events
+        if first is not None and (estimate["first"] is None or first < estimate["first"]):
+            estimate["first"] = first
+        if last is not None and (estimate["last"] is None or last > estimate["last"]):
+            estimate["last"] = last
+    return estimates
+
+# Plan de deelverzoeken voor een opvraging. Bij een schatting boven MAX_EVENTS_PER_QUERY
+# wordt alleen het meest recente deel van de periode opgehaald, met een waarschuwing
+def prepare_timeseries_requests(api_url, location_ids, parameter_ids, start_date=None, end_date=None):
+    if isinstance(location_ids, str):
+        location_ids = [location_ids.strip()]
+    if isinstance(parameter_ids, str):
+        parameter_ids = [parameter_ids.strip()]
+    
+    estimates = estimate_timeseries_size(api_url, location_ids, parameter_ids, start_date, end_date) if PREFLIGHT_ESTIMATION else None
+    if estimates is None:
+        return plan_timeseries_requests(location_ids, parameter_ids, start_date, end_date), None
+    
+    warning = None
+    total = sum(estimate["events"] for estimate in estimates.values())
+    firsts = [estimate["first"] for estimate in estimates.values() if estimate["first"] is not None]
+    lasts = [estimate["last"] for estimate in estimates.values() if estimate["last"] is not None]
+    if total > MAX_EVENTS_PER_QUERY and firsts and lasts:
+        first = pd.Timestamp(start_date) if start_date else min(firsts)
+        last = pd.Timestamp(end_date) if end_date else max(lasts)
+        fraction = MAX_EVENTS_PER_QUERY / total
+        start_date = format_timestamp((last - (last - first) * fraction).ceil("h"))
+        for estimate in estimates.values():
+            estimate["events"] = int(estimate["events"] * fraction) + 1
+            estimate["first"] = max(estimate["first"], pd.Timestamp(start_date)) if estimate["first"] is not None else None
+        warning = (f"Let op: de selectie bevat naar schatting {total} events, meer dan het maximum van "
+                   f"{MAX_EVENTS_PER_QUERY}. Alleen de periode vanaf {start_date} is opgehaald.")
+    
+    filters = match_filters(api_url, location_ids)
+    return plan_timeseries_requests(location_ids, parameter_ids, start_date, end_date, estimates, filters), warning
+
+def fetch_timeseries_chunk(api_url, sub_request, cancel_event=None):
+    attributes = {
+        "fews.locations": len(sub_request["location_ids"]),
+        "fews.parameters": len(sub_request["parameter_ids"]),
+        "fews.filter_id": sub_request.get("filter_id") or ""
+    }
+    with trace_span("deelverzoek", attributes):
+        with profile_stage("schijfcache"):
+            cached_df = load_cached_series(api_url, sub_request)
+            set_span_attributes({"cache.hit": cached_df is not None})
+        if cached_df is not None:
+            record_metric("series_cache_hits")
+            return None, cached_df
+        record_metric("series_cache_misses")
+        
+        data = get_timeseries(api_url, sub_request["location_ids"], sub_request["parameter_ids"],
+                              sub_request["start_date"], sub_request["end_date"], cancel_event, sub_request.get("filter_id"))
+        if "error" in data:
+            return data["error"], None
+        # Sla de verwerking over als de opvraging intussen is geannuleerd
+        if cancel_event is not None and cancel_event.is_set():
+            return "Verzoek geannuleerd", None
+        
+        with profile_stage("DataFrame"):
+            df = timeseries_to_dataframe(data)
+            # Een filter kan intussen locaties buiten de selectie bevatten
+            if df is not None and sub_request.get("filter_id"):
+                df = df[df["locationId"].isin(sub_request["location_ids"])]
+                df = df if not df.empty else None
+            set_span_attributes({"fews.events": 0 if df is None else len(df)})
+        if df is not None:
+            with profile_stage("schijfcache"):
+                store_cached_series(api_url, sub_request, df)
+        return None, df
+
+# Voer de deelverzoeken parallel uit en geef per afgerond deelverzoek (fout, DataFrame) terug,
+# in de volgorde waarin ze binnenkomen
+def iter_timeseries_chunks(api_url, sub_requests, cancel_event=None):
+    executor = ThreadPoolExecutor(max_workers=TIMESERIES_MAX_WORKERS)
+    # Elk deelverzoek krijgt een kopie van de context, zodat een actief profiel en de actieve span meegaan
+    futures = [
+        executor.submit(contextvars.copy_context().run, fetch_timeseries_chunk, api_url, sub_request, cancel_event)
+        for sub_request in sub_requests
+    ]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # Deelverzoeken die nog niet gestart zijn vervallen als de opvraging eerder stopt;
+        # lopende verzoeken breken zelf af via cancel_event
+        not_started = sum(future.cancel() for future in futures)
+        if not_started:
+            record_metric("cancelled_requests", not_started)
+        executor.shutdown(wait=False)
+
+# Voeg de deelresultaten samen tot één chronologisch gesorteerd DataFrame
+def combine_timeseries_chunks(chunks):
+    if not chunks:
+        return None
+    with profile_stage("DataFrame", {"fews.chunks": len(chunks)}):
+        # Deelresultaten uit de schijfcache hebben categorische tekstkolommen; met gezamenlijke
+        # categorieën blijven die bij het samenvoegen categorisch
+        for column in CATEGORICAL_COLUMNS:
+            if len(chunks) > 1 and all(isinstance(chunk[column].dtype, pd.CategoricalDtype) for chunk in chunks):
+                categories = union_categoricals([chunk[column] for chunk in chunks], sort_categories=True).categories
+                chunks = [chunk.assign(**{column: chunk[column].cat.set_categories(categories)}) for chunk in chunks]
+        df = pd.concat(chunks, ignore_index=True).sort_values(by="timestamp")
+        set_span_attributes({"fews.events": len(df)})
+        return df
+
+# Selecteer locaties, parameters en een periode (grenzen inclusief) uit een resultaat
+def select_timeseries(df, location_ids, parameter_ids, start_date=None, end_date=None):
+    mask = df["locationId"].isin(location_ids).to_numpy() & df["parameterId"].isin(parameter_ids).to_numpy()
+    if start_date:
+        mask &= (df["timestamp"] >= pd.Timestamp(start_date)).to_numpy()
+    if end_date:
+        mask &= (df["timestamp"] <= pd.Timestamp(end_date)).to_numpy()
+    return df if mask.all() else df[mask]
+
+# Batch-opvragingen: overlappende opvragingen (locaties, parameters, periode) worden samen-
+# gevoegd tot niet-overlappende verzoeken. Per locatie-parameter combinatie worden de gevraagde
+# perioden verenigd; combinaties met dezelfde periode en, per locatie, dezelfde parameters delen
+# één verzoek. Elke combinatie en elk tijdstip wordt zo hoogstens één keer opgehaald
+OPEN_START = np.iinfo(np.int64).min
+OPEN_END = np.iinfo(np.int64).max
+
+def query_period(query):
+    start = pd.Timestamp(query["start_date"]).value if query.get("start_date") else OPEN_START
+    end = pd.Timestamp(query["end_date"]).value if query.get("end_date") else OPEN_END
+    return start, end
+
+def period_bound(value):
+    if value in (OPEN_START, OPEN_END):
+        return None
+    return format_timestamp(pd.Timestamp(value, tz="UTC"))
+
+# Verenig overlappende perioden; de grenzen zijn inclusief
+def merge_periods(periods):
+    merged = []
+    for start, end in sorted(periods):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(period) for period in merged]
+
+def plan_batch_requests(queries):
+    pair_periods = {}
+    for query in queries:
+        period = query_period(query)
+        for location_id in query["location_ids"]:
+            for parameter_id in query["parameter_ids"]:
+                pair_periods.setdefault((location_id, parameter_id), []).append(period)
+    
+    by_period = {}
+    for (location_id, parameter_id), periods in pair_periods.items():
+        for period in merge_periods(periods):
+            by_period.setdefault(period, {}).setdefault(location_id, []).append(parameter_id)
+    
+    requests_ = []
+    for (start, end), locations in sorted(by_period.items()):
+        by_parameters = {}
+        for location_id, parameter_ids in locations.items():
+            by_parameters.setdefault(tuple(sorted(parameter_ids)), []).append(location_id)
+        for parameter_ids, location_ids in sorted(by_parameters.items()):
+            requests_.append({
+                "location_ids": sorted(location_ids),
+                "parameter_ids": list(parameter_ids),
+                "start_date": period_bound(start),
+                "end_date": period_bound(end)
+            })
+    return requests_
+
+# Haal een batch op: plan de gedeelde verzoeken, haal ze (opgesplitst zoals elke opvraging)
+# parallel op en snijd het gezamenlijke resultaat terug per opvraging
+def fetch_timeseries_batch(api_url, queries, cancel_event=None):
+    batch_requests = plan_batch_requests(queries)
+    sub_requests = []
+    warnings_ = []
+    for batch_request in batch_requests:
+        planned, warning = prepare_timeseries_requests(api_url, batch_request["location_ids"], batch_request["parameter_ids"],
+                                                       batch_request["start_date"], batch_request["end_date"])
+        sub_requests.extend(planned)
+        if warning:
+            warnings_.append(warning)
+    
+    chunks = []
+    errors = []
+    with InFlightMemory() as in_flight:
+        for error, chunk_df in iter_timeseries_chunks(api_url, sub_requests, cancel_event):
+            if error:
+                errors.append(error)
+            elif chunk_df is not None:
+                chunks.append(chunk_df)
+                if not in_flight.add(chunk_df):
+                    return [None] * len(queries), batch_requests, [in_flight.refusal()], warnings_
+        df = combine_timeseries_chunks(chunks)
+    results = [
+        select_timeseries(df, query["location_ids"], query["parameter_ids"], query.get("start_date"), query.get("end_date"))
+        if df is not None else None
+        for query in queries
+    ]
+    return results, batch_requests, errors, warnings_
+
+# Vergelijken: haal dezelfde opvraging gelijktijdig op bij twee webservices
+def fetch_comparison(api_url_a, api_url_b, query, cancel_event=None):
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, fetch_timeseries_batch, api_url, [query], cancel_event)
+            for api_url in (api_url_a, api_url_b)
+        ]
+        return [future.result() for future in futures]
+
+# As-of join in beide richtingen: per event van A de positie van het dichtstbijzijnde event
+# van B met dezelfde sleutel binnen de tolerantie (-1 zonder tegenhanger), en omgekeerd. Elke
+# kant krijgt één gehele sortering sleutel * breedte + tijd, zodat gesorteerde searchsorted
+# volstaat; de tijd wordt zo grof genomen (ns, µs, ms, s) dat die in int64 past en de
+# koppelingen worden daarna op de exacte tijd gecontroleerd
+def asof_match(keys_a, times_a, keys_b, times_b, tolerance):
+    if not len(keys_a) or not len(keys_b):
+        return np.full(len(keys_a), -1), np.full(len(keys_b), -1)
+    
+    start = min(times_a.min(), times_b.min())
+    span = max(times_a.max(), times_b.max()) - start + tolerance
+    n = int(max(keys_a.max(), keys_b.max())) + 1
+    unit = 1
+    while n * (span // unit + 2) >= 2**62:
+        unit *= 1000
+    width = span // unit + 2
+    
+    sides = []
+    for keys, times in ((keys_a, times_a), (keys_b, times_b)):
+        composite = keys.astype(np.int64) * width + (times - start) // unit
+        order = np.argsort(composite, kind="stable")
+        sides.append((keys, times, order, composite[order]))
+    
+    def nearest(query, reference):
+        keys, times, order, sorted_composite = query
+        ref_keys, ref_times, ref_order, ref_sorted = reference
+        position = np.searchsorted(ref_sorted, sorted_composite)
+        before = np.clip(position - 1, 0, len(ref_sorted) - 1)
+        after = np.minimum(position, len(ref_sorted) - 1)
+        take_after = np.abs(ref_sorted[after] - sorted_composite) < np.abs(sorted_composite - ref_sorted[before])
+        candidate = ref_order[np.where(take_after, after, before)]
+        found = (ref_keys[candidate] == keys[order]) & (np.abs(ref_times[candidate] - times[order]) <= tolerance)
+        matches = np.full(len(keys), -1)
+        matches[order[found]] = candidate[found]
+        return matches
+    
+    return nearest(sides[0], sides[1]), nearest(sides[1], sides[0])
+
+# Koppel de events van A en B per reeks (en ensemblelid) en vat de verschillen per reeks
+# samen. Geeft de samenvatting en per event de reekssleutel van A en B terug, zodat de
+# afwijkende reeksen zonder nieuwe groupby geplot kunnen worden
+def compare_timeseries(df_a, df_b):
+    df_a = df_a if df_a is not None else pd.DataFrame(columns=TIMESERIES_COLUMNS)
+    df_b = df_b if df_b is not None else pd.DataFrame(columns=TIMESERIES_COLUMNS)
+    
+    with profile_stage("DataFrame", {"fews.events": len(df_a) + len(df_b)}):
+        # Eén gehele sleutel per reeks en lid, gedeeld door beide kanten
+        series_codes, series_ids = pd.factorize(np.concatenate([df_a["series_id"].to_numpy(), df_b["series_id"].to_numpy()]), sort=True)
+        member_codes, members = pd.factorize(np.concatenate([df_a["member"].to_numpy(), df_b["member"].to_numpy()]), sort=True)
+        pairs, pair_index = pd.factorize(series_codes.astype(np.int64) * (len(members) + 1) + member_codes + 1, sort=True)
+        key_a, key_b = pairs[:len(df_a)], pairs[len(df_a):]
+        member_labels = np.concatenate([[""], np.asarray(members, dtype=object)])
+        
+        # .values geeft de tijdstippen als datetime64 (UTC), zonder Timestamp-objecten
+        times_a = df_a["timestamp"].values.astype("datetime64[ns]").view("int64")
+        times_b = df_b["timestamp"].values.astype("datetime64[ns]").view("int64")
+        values_a = df_a["value"].to_numpy(dtype=float)
+        values_b = df_b["value"].to_numpy(dtype=float)
+        tolerance = int(COMPARE_TOLERANCE_SECONDS * 10**9)
+        
+        match_a, match_b = asof_match(key_a, times_a, key_b, times_b, tolerance)
+        diff = np.full(len(values_a), np.nan)
+        diff[match_a >= 0] = values_b[match_a[match_a >= 0]] - values_a[match_a >= 0]
+        
+        n = len(pair_index)
+        matched = ~np.isnan(diff)
+        events_a = np.bincount(key_a, minlength=n)
+        events_b = np.bincount(key_b, minlength=n)
+        matched_a = np.bincount(key_a[matched], minlength=n)
+        found_b = np.bincount(key_b[match_b >= 0], minlength=n)
+        diff_sum = np.bincount(key_a[matched], weights=diff[matched], minlength=n)
+        max_abs = pd.Series(np.abs(diff[matched])).groupby(key_a[matched]).max().reindex(range(n)).to_numpy()
+        
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_diff = diff_sum / matched_a
+        missing_in_b = events_a - matched_a
+        missing_in_a = events_b - found_b
+        divergent = (np.nan_to_num(max_abs) > COMPARE_ATOL) | (missing_in_a > 0) | (missing_in_b > 0)
+        
+        stats = pd.DataFrame({
+            "reeks": np.asarray(series_ids, dtype=object)[pair_index // (len(members) + 1)],
+            "lid": member_labels[pair_index % (len(members) + 1)],
+            "events A": events_a,
+            "events B": events_b,
+            "gekoppeld": matched_a,
+            "ontbreekt in A": missing_in_a,
+            "ontbreekt in B": missing_in_b,
+            "max. abs. verschil": max_abs,
+            "gem. verschil (B - A)": mean_diff,
+            "afwijkend": divergent
+        })
+    return {"stats": stats, "key_a": key_a, "key_b": key_b}
+
+# Gedeelde live feeds per reeks (webservice, locatie, parameter, lid). Elke feed houdt de
+# recent opgehaalde events bij vanaf "start"; een reeks wordt hoogstens één keer per
+# LIVE_POLL_INTERVAL bij de webservice opgevraagd, ongeacht het aantal kijkers. Een feed
+# die LIVE_FEED_IDLE_SECONDS niet is gelezen ("read") vervalt
+_live_feeds = {}
+_live_feeds_lock = threading.Lock()
+
+def format_timestamp(timestamp):
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC")
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# Geef de events terug die nieuwer zijn dan de laatste bekende timestamp per reeks en
+# ensemblelid (series_last: {(locatie, parameter, lid): laatste timestamp}, lid "" zonder ensemble)
+def poll_live_events(api_url, series_last):
+    key_prefix = endpoint_key(api_url)
+    now = time.time()
+    expire_memory()
+    
+    # Bepaal welke reeksen opgevraagd moeten worden en claim ze, zodat gelijktijdige
+    # kijkers niet dezelfde reeks opnieuw opvragen. Een reeks wordt opgevraagd vanaf het
+    # nieuwste event in de feed, of vanaf de eigen laatste timestamp als de feed die niet dekt
+    with _live_feeds_lock:
+        stale = {}
+        for series, last in series_last.items():
+            feed = _live_feeds.get((key_prefix, *series))
+            if feed is not None:
+                feed["read"] = now
+            covered = feed is not None and feed["start"] is not None and last >= feed["start"]
+            if not covered or now - feed["polled"] >= LIVE_POLL_INTERVAL:
+                if feed is None:
+                    feed = _live_feeds[(key_prefix, *series)] = {"start": None, "polled": now, "events": None, "read": now}
+                feed["polled"] = now
+                newest = feed["start"]
+                if feed["events"] is not None and not feed["events"].empty:
+                    newest = feed["events"]["timestamp"].max()
+                stale[series] = max(last, newest) if covered else last
+    
+    # Eén verzoek per groep reeksen met hetzelfde beginpunt en dezelfde parameters, zodat
+    # alleen de bewaarde locatie-parameter combinaties worden opgevraagd
+    groups = {}
+    for series, since in stale.items():
+        groups.setdefault(since, {}).setdefault(series[0], set()).add(series[1])
+    requests_ = {}
+    for since, location_parameters in groups.items():
+        for location_id, parameter_ids in location_parameters.items():
+            requests_.setdefault((since, tuple(sorted(parameter_ids))), []).append(location_id)
+    
+    polled = []
+    for (since, parameter_ids), location_ids in requests_.items():
+        data = get_timeseries(api_url, sorted(location_ids), list(parameter_ids), format_timestamp(since))
+        if "error" in data:
+            return data["error"], None
+        polled_df = timeseries_to_dataframe(data)
+        if polled_df is not None:
+            polled.append(polled_df)
+    polled_df = pd.concat(polled, ignore_index=True) if polled else None
+    
+    new_events = []
+    with _live_feeds_lock:
+        for series, last in series_last.items():
+            # De feed kan tijdens een trage opvraging zijn vervallen; begin dan opnieuw
+            feed = _live_feeds.setdefault((key_prefix, *series), {"start": None, "polled": now, "events": None, "read": now})
+            if series in stale:
+                if polled_df is not None:
+                    mask = ((polled_df["locationId"] == series[0]) & (polled_df["parameterId"] == series[1])
+                            & (polled_df["member"].fillna("") == series[2]))
+                    events = pd.concat([feed["events"], polled_df[mask]]) if feed["events"] is not None else polled_df[mask]
+                    feed["events"] = events.drop_duplicates(subset=["timestamp", "member"], keep="last")
+                feed["start"] = stale[series] if feed["start"] is None else min(feed["start"], stale[series])
+            
+            # De kijker krijgt alle nieuwe events, ook als die buiten de bewaartermijn van de feed vallen
+            if feed["events"] is not None:
+                new_events.append(feed["events"][feed["events"]["timestamp"] > last])
+            
+            # Events ouder dan de bewaartermijn (gerekend vanaf het nieuwste event) vervallen;
+            # kijkers die verder achterlopen vragen zelf opnieuw op
+            if series in stale and feed["events"] is not None and not feed["events"].empty:
+                cutoff = feed["events"]["timestamp"].max() - pd.Timedelta(hours=LIVE_FEED_RETENTION_HOURS)
+                if feed["start"] < cutoff:
+                    feed["start"] = cutoff
+                    feed["events"] = feed["events"][feed["events"]["timestamp"] >= cutoff]
+                account_memory("live feeds", (key_prefix, *series), frame_memory(feed["events"]))
+    
+    new_events = [events for events in new_events if not events.empty]
+    if not new_events:
+        return None, None
+    return None, pd.concat(new_events, ignore_index=True)
+
+# Gaten en volledigheid per reeks in lineaire tijd. Het resultaat is chronologisch gesorteerd,
+# dus een stabiele sortering op reeks (radix sort zolang de codes in 16 bits passen) geeft elke
+# reeks als aaneengesloten, gesorteerd blok. De tijdstap van een reeks is de meest voorkomende
+# stap tussen opeenvolgende tijdstippen (geteld met een hashtabel); een interval groter dan
+# GAP_FACTOR maal de tijdstap is een gat. Met een periode tellen ook ontbrekende tijdstappen
+# aan het begin en eind van de periode mee. Leden van een ensemble delen hun tijdstippen
+def detect_gaps(df, start_date=None, end_date=None):
+    with profile_stage("gaten", {"fews.events": len(df)}):
+        codes, series_ids = pd.factorize(df["series_id"], sort=True)
+        n = len(series_ids)
+        timestamps = df["timestamp"].values.view("int64")
+        
+        if len(timestamps) < 2 or (timestamps[1:] >= timestamps[:-1]).all():
+            order = np.argsort(codes.astype(np.uint16) if n <= 2**16 else codes, kind="stable")
+        else:
+            order = np.lexsort((timestamps, codes))
+        sorted_codes = codes[order]
+        sorted_times = timestamps[order]
+        counts = np.bincount(codes, minlength=n)
+        ends = np.cumsum(counts)
+        first = sorted_times[ends - counts]
+        last = sorted_times[ends - 1]
+        
+        # Stappen binnen dezelfde reeks; dubbele tijdstippen (ensembleleden) tellen niet als stap
+        steps = np.diff(sorted_times)
+        same_series = (sorted_codes[1:] == sorted_codes[:-1]) & (steps > 0)
+        step_codes = sorted_codes[1:][same_series]
+        steps = steps[same_series]
+        step_ends = sorted_times[1:][same_series]
+        
+        counted = pd.DataFrame({"code": step_codes, "step": steps}).groupby(["code", "step"], sort=False).size()
+        counted = counted.reset_index(name="count")
+        mode = counted.loc[counted.groupby("code", sort=False)["count"].idxmax()]
+        step = np.zeros(n, dtype=np.int64)
+        step[mode["code"].to_numpy()] = mode["step"].to_numpy()
+        has_step = step > 0
+        
+        is_gap = steps > GAP_FACTOR * step[step_codes]
+        gap_codes = step_codes[is_gap]
+        gap_begin = step_ends[is_gap] - steps[is_gap]
+        gap_end = step_ends[is_gap]
+        gap_missing = np.rint(steps[is_gap] / step[gap_codes]).astype(np.int64) - 1
+        
+        # Ontbrekende tijdstappen vóór het eerste en na het laatste tijdstip binnen de periode
+        edges = []
+        safe_step = np.where(has_step, step, 1)
+        if start_date:
+            period_start = pd.Timestamp(start_date).value
+            leading = np.where(has_step, (first - period_start) // safe_step, 0)
+            edges.append((np.flatnonzero(leading > 0), np.full(n, period_start), first, leading))
+        if end_date:
+            period_end = pd.Timestamp(end_date).value
+            trailing = np.where(has_step, (period_end - last) // safe_step, 0)
+            edges.append((np.flatnonzero(trailing > 0), last, np.full(n, period_end), trailing))
+        for edge_codes, begin, end, missing in edges:
+            gap_codes = np.concatenate([gap_codes, edge_codes])
+            gap_begin = np.concatenate([gap_begin, begin[edge_codes]])
+            gap_end = np.concatenate([gap_end, end[edge_codes]])
+            gap_missing = np.concatenate([gap_missing, missing[edge_codes]])
+        
+        present = np.bincount(step_codes, minlength=n) + 1
+        expected = present + np.bincount(gap_codes, weights=gap_missing, minlength=n).astype(np.int64)
+        series = pd.DataFrame({
+            "series_id": series_ids,
+            "tijdstap": pd.to_timedelta(np.where(has_step, step, np.iinfo(np.int64).min), unit="ns"),
+            "verwacht": np.where(has_step, expected, present),
+            "aanwezig": present,
+            "volledigheid (%)": np.where(has_step, np.round(100 * present / expected, 1), np.nan),
+            "gaten": np.bincount(gap_codes, minlength=n)
+        })
+        gaps = pd.DataFrame({
+            "series_id": np.asarray(series_ids, dtype=object)[gap_codes],
+            "begin": pd.to_datetime(gap_begin, utc=True),
+            "eind": pd.to_datetime(gap_end, utc=True),
+            "ontbrekend": gap_missing
+        })
+    return {"series": series, "gaps": gaps}
+
+# De langste GAP_TABLE_MAX_ROWS gaten, de langste eerst
+def longest_gaps(intervals):
+    duration = intervals["eind"] - intervals["begin"]
+    return intervals.assign(duur=duration).sort_values("duur", ascending=False).head(GAP_TABLE_MAX_ROWS)
+
+# De langste gaten voor de tabel
+def gap_table(gaps):
+    intervals = gaps["gaps"]
+    if intervals.empty:
+        return None
+    return longest_gaps(intervals)
+
+# Samenvatting per reeks in één gevectoriseerde doorgang: aantal events, min, max, gemiddelde,
+# eerste en laatste tijdstip en uit de gatenanalyse de tijdstap, volledigheid en het aantal gaten
+def summarize_timeseries(df, gaps=None):
+    if df is None or df.empty:
+        return None
+    if gaps is None:
+        gaps = detect_gaps(df)
+    
+    codes, series_ids = pd.factorize(df["series_id"], sort=True)
+    n = len(series_ids)
+    values = df["value"].to_numpy(dtype=float)
+    stats = pd.Series(values).groupby(codes).agg(["min", "max", "mean"]).reindex(range(n))
+    times = df["timestamp"].groupby(codes).agg(["min", "max"]).reindex(range(n))
+    
+    return pd.DataFrame({
+        "series_id": series_ids,
+        "aantal": np.bincount(codes, minlength=n),
+        "aantal waarden": np.bincount(codes, weights=~np.isnan(values), minlength=n).astype(int),
+        "min": stats["min"].to_numpy(),
+        "max": stats["max"].to_numpy(),
+        "gemiddelde": stats["mean"].to_numpy(),
+        "eerste": times["min"].to_numpy(),
+        "laatste": times["max"].to_numpy(),
+        "tijdstap": gaps["series"]["tijdstap"].to_numpy(),
+        "volledigheid (%)": gaps["series"]["volledigheid (%)"].to_numpy(),
+        "gaten": gaps["series"]["gaten"].to_numpy(),
+    })
+
+# Eén pagina van de tabel, gelezen op offset uit het resultaat van de sessie
+def timeseries_page(df, page=1):
+    if df is None or len(df) == 0:
+        return None, 1, ""
+    pages = max(1, -(-len(df) // TABLE_PAGE_SIZE))
+    page = min(max(1, int(page or 1)), pages)
+    offset = (page - 1) * TABLE_PAGE_SIZE
+    if isinstance(df, pa.Table):
+        rows = df.slice(offset, TABLE_PAGE_SIZE).to_pandas()
+    else:
+        rows = df.iloc[offset:offset + TABLE_PAGE_SIZE]
+    rows = plain_columns(rows)
+    info = f"Rijen {offset + 1}-{offset + len(rows)} van {len(df)} (pagina {page} van {pages})"
+    return rows, page, info
+
+# Uitvoer voor de tabelweergave: samenvatting, tabelpagina, paginanummer en pagina-informatie
+def table_outputs(df, page=1, gaps=None):
+    if gaps is None:
+        gaps = detect_gaps(df)
+    return (summarize_timeseries(df, gaps), *timeseries_page(df, page), gap_table(gaps))
+
+EMPTY_TABLE = (None, None, 1, "", None)
+SKIP_TABLE = (gr.skip(),) * 5
+
+# Maximale omvang (tijdstippen x reeksen) van de matrixweergave en het minimale aantal
+# gemeenschappelijke tijdstippen voor een correlatie
+MATRIX_MAX_CELLS = int(os.getenv("MATRIX_MAX_CELLS", "2000000"))
+MIN_CORRELATION_OVERLAP = 3
+# Maximaal aantal afwijkende reeksen in de vergelijkingsgrafiek
+COMPARE_MAX_PLOTTED = 20
+
+# Deltares kleurenpalet voor de plot
+FIGURE_COLORS = [
+    DELTARES_BLUE, DELTARES_DARK_BLUE, DELTARES_LIGHT_BLUE,
+    "#5DACDB", "#8ABCDB", "#B9D9ED"  # Extra lichtblauwe tinten
+]
+
+# Cache van geserialiseerde grafieken per opvraging en layoutopties, zodat een identieke
+# opvraging de grafiek niet opnieuw hoeft op te bouwen en te serialiseren
+_figure_cache = OrderedDict()
+_figure_cache_lock = threading.Lock()
+
+def timeseries_query_key(api_url, location_ids, parameter_ids, start_date, end_date):
+    return (endpoint_key(api_url), tuple(sorted(location_ids)), tuple(sorted(parameter_ids)), start_date, end_date)
+
+# Splits het resultaat in numpy arrays per reeks; het resultaat is chronologisch gesorteerd
+# en een stabiele sortering op reeks behoudt die volgorde binnen elke reeks
+def group_series(df):
+    codes, series_ids = pd.factorize(df["series_id"], sort=True)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(series_ids) + 1))
+    timestamps = df["timestamp"].values[order]
+    values = df["value"].to_numpy(dtype=float)[order]
+    for i, series_id in enumerate(series_ids):
+        yield series_id, timestamps[bounds[i]:bounds[i + 1]], values[bounds[i]:bounds[i + 1]]
+
+# Zet de leden van elke ensemblereeks in een 2-D array (tijd x lid). Tijdstippen waarop een
+# lid geen waarde heeft blijven NaN
+def ensemble_arrays(df):
+    ensembles = {}
+    members_df = df[df["member"].notna()]
+    for series_id, group in members_df.groupby("series_id", sort=True, observed=True):
+        time_codes, times = pd.factorize(group["timestamp"], sort=True)
+        member_codes, members = pd.factorize(group["member"], sort=True)
+        values = np.full((len(times), len(members)), np.nan)
+        values[time_codes, member_codes] = group["value"].to_numpy(dtype=float)
+        ensembles[series_id] = {"times": times.values, "members": members.tolist(), "values": values}
+    return ensembles
+
+# Percentielen over de leden per tijdstip, in één aanroep voor alle tijdstippen
+def ensemble_percentiles(values, percentiles=ENSEMBLE_PERCENTILES):
+    with warnings.catch_warnings():
+        # Tijdstippen zonder enkele waarde geven NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanpercentile(values, percentiles, axis=1)
+
+def transparent(color, alpha):
+    color = color.lstrip("#")
+    red, green, blue = (int(color[i:i + 2], 16) for i in (0, 2, 4))
+    return f"rgba({red},{green},{blue},{alpha})"
+
+# Gaten als gearceerde vlakken in de kleur van de reeks: per reeks één trace met een
+# rechthoek per gat over het bereik van de waarden, in dezelfde legendagroep als de reeks.
+# Alleen de langste GAP_TABLE_MAX_ROWS gaten (dezelfde als in de tabel) worden gearceerd
+def gap_traces(intervals, colors, values):
+    intervals = longest_gaps(intervals)
+    finite = values[np.isfinite(values)]
+    low, high = (finite.min(), finite.max()) if len(finite) else (0.0, 1.0)
+    if low == high:
+        low, high = low - 1, high + 1
+    
+    codes, series_ids = pd.factorize(intervals["series_id"])
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(series_ids) + 1))
+    begin = intervals["begin"].values[order]
+    end = intervals["eind"].values[order]
+    corners_y = np.tile([low, high, high, low, np.nan], bounds[-1])
+    traces = []
+    for i, series_id in enumerate(series_ids):
+        b, e = begin[bounds[i]:bounds[i + 1]], end[bounds[i]:bounds[i + 1]]
+        separator = np.full(len(b), np.datetime64("NaT"), dtype=b.dtype)
+        color = colors.get(series_id, DELTARES_DARK_GREY)
+        traces.append({
+            "type": "scatter",
+            "name": f"{series_id} (gaten)",
+            "legendgroup": series_id,
+            "showlegend": False,
+            "x": np.column_stack([b, b, e, e, separator]).ravel(),
+            "y": corners_y[:5 * len(b)],
+            "mode": "lines",
+            "fill": "toself",
+            "fillcolor": transparent(color, 0.15),
+            "line": {"width": 0},
+            "hoverinfo": "skip"
+        })
+    return traces
+
+# Bandtraces voor één ensemblereeks: per paar percentielen (van buiten naar binnen) een
+# onzichtbare ondergrens en een bovengrens die tot de ondergrens gevuld wordt
+def ensemble_traces(series_id, ensemble, color):
+    percentiles = sorted(ENSEMBLE_PERCENTILES)
+    bands = ensemble_percentiles(ensemble["values"], percentiles)
+    traces = []
+    for i in range(len(percentiles) // 2):
+        low, high = i, len(percentiles) - 1 - i
+        traces.append({
+            "type": "scattergl",
+            "x": ensemble["times"],
+            "y": bands[low],
+            "mode": "lines",
+            "line": {"width": 0, "color": color},
+            "legendgroup": series_id,
+            "showlegend": False,
+            "hoverinfo": "skip"
+        })
+        traces.append({
+            "type": "scattergl",
+            "name": f"{series_id} (P{percentiles[low]:g}-P{percentiles[high]:g}, {len(ensemble['members'])} leden)",
+            "x": ensemble["times"],
+            "y": bands[high],
+            "mode": "lines",
+            "line": {"width": 0, "color": color},
+            "fill": "tonexty",
+            "fillcolor": transparent(color, 0.2 + 0.15 * i),
+            "legendgroup": series_id
+        })
+    if len(percentiles) % 2:
+        middle = len(percentiles) // 2
+        traces.append({
+            "type": "scattergl",
+            "name": f"{series_id} (P{percentiles[middle]:g})",
+            "x": ensemble["times"],
+            "y": bands[middle],
+            "mode": "lines",
+            "line": {"color": color},
+            "legendgroup": series_id
+        })
+    return traces
+
+# Bouw de grafiek met één Scattergl trace per reeks, zonder de validatie van Plotly, en geef
+# hem geserialiseerd terug. Met een query_key wordt het resultaat gecachet; de omvang en het
+# laatste tijdstip horen bij de sleutel, zodat een resultaat met nieuwe events (live modus)
+# een nieuwe grafiek krijgt. Ensemblereeksen worden als percentielbanden getoond, uit de
+# arrays van ensemble_arrays (die worden berekend als ze niet zijn meegegeven)
+def build_timeseries_figure(df, query_key=None, markers=True, ensembles=None, gaps=None):
+    cache_key = (query_key, "lijnen", markers, gaps is not None, len(df), df["timestamp"].max()) if query_key is not None else None
+    return cached_plot(cache_key, lambda: timeseries_figure(df, markers, ensembles, gaps))
+
+# Zoek een geserialiseerde grafiek op in de cache, of bouw en serialiseer hem met build
+def cached_plot(cache_key, build):
+    if cache_key is not None and FIGURE_CACHE_SIZE > 0:
+        with _figure_cache_lock:
+            plot = _figure_cache.get(cache_key)
+            if plot is not None:
+                _figure_cache.move_to_end(cache_key)
+        if plot is not None:
+            record_metric("figure_cache_hits")
+            # Een cache-treffer verschijnt in de trace als (vrijwel) lege grafiekfase
+            with trace_span("grafiek", {"cache.hit": True}):
+                return plot
+        record_metric("figure_cache_misses")
+    
+    with profile_stage("grafiek", {"cache.hit": False}):
+        fig = build()
+        set_span_attributes({"plot.traces": len(fig.data)})
+    
+    with profile_stage("serialisatie (grafiek)"):
+        plot = PlotData(type="plotly", plot=fig.to_json())
+        set_span_attributes({"fews.bytes": len(plot.plot)})
+    
+    # Een grafiek die niet meer in het geheugenbudget past, wordt niet gecachet
+    if cache_key is not None and FIGURE_CACHE_SIZE > 0 and reserve_memory("grafiekcache", cache_key, len(plot.plot)):
+        with _figure_cache_lock:
+            _figure_cache[cache_key] = plot
+            while len(_figure_cache) > FIGURE_CACHE_SIZE:
+                release_memory("grafiekcache", _figure_cache.popitem(last=False)[0])
+    return plot
+
+# Maak ten minste nbytes vrij door de oudste grafieken uit de cache te verwijderen
+def evict_figure_cache(nbytes):
+    freed = 0
+    with _figure_cache_lock:
+        while _figure_cache and freed < nbytes:
+            cache_key, plot = _figure_cache.popitem(last=False)
+            release_memory("grafiekcache", cache_key)
+            freed += len(plot.plot)
+    return freed
+
+def timeseries_figure(df, markers=True, ensembles=None, gaps=None):
+    traces = []
+    colors = {}
+    is_member = df["member"].notna().to_numpy()
+    for i, (series_id, timestamps, values) in enumerate(group_series(df[~is_member])):
+        color = colors[series_id] = FIGURE_COLORS[i % len(FIGURE_COLORS)]
+        traces.append({
+            "type": "scattergl",
+            "name": series_id,
+            "legendgroup": series_id,
+            "x": timestamps,
+            "y": values,
+            # Markers voor elke meting
+            "mode": "lines+markers" if markers else "lines",
+            "line": {"color": color},
+            "marker": {"color": color, "size": 6}
+        })
+    
+    if is_member.any():
+        if ensembles is None:
+            ensembles = ensemble_arrays(df[is_member])
+        offset = len(traces)
+        for i, (series_id, ensemble) in enumerate(ensembles.items()):
+            color = colors[series_id] = FIGURE_COLORS[(offset + i) % len(FIGURE_COLORS)]
+            traces.extend(ensemble_traces(series_id, ensemble, color))
+    
+    if gaps is not None and not gaps["gaps"].empty:
+        traces = gap_traces(gaps["gaps"], colors, df["value"].to_numpy(dtype=float)) + traces
+    
+    grid = {"showgrid": True, "gridwidth": 0.5, "gridcolor": "rgba(0,0,0,0.1)"}
+    layout = {
+        "title": {"text": "Tijdseries voor alle locatie-parameter combinaties", "font": {"size": 18, "color": DELTARES_BLACK}},
+        "xaxis": {"title": {"text": "Datum"}, **grid},
+        "yaxis": {"title": {"text": "Waarde"}, **grid},
+        "hovermode": "x unified",  # Alle waardes tonen bij hover op dezelfde x-positie
+        "font": {"family": "Roboto, Arial, sans-serif"},
+        "plot_bgcolor": DELTARES_WHITE,
+        "paper_bgcolor": DELTARES_WHITE,
+        "legend": {
+            "title": {"text": "Locatie - Parameter", "font": {"size": 12}},
+            "orientation": "v",
+            "yanchor": "top",
+            "y": 0.99,
+            "xanchor": "left",
+            "x": 1.02,
+            "font": {"size": 10}
+        },
+        "margin": {"l": 50, "r": 150, "t": 80, "b": 50}
+    }
+    return go.Figure(data=traces, layout=layout, _validate=False)
+
+# Matrixweergave: het resultaat als matrix (tijd x reeks) op een gemeenschappelijk, regelmatig
+# tijdrooster met de mediane tijdstap van de reeksen (grover als het rooster groter wordt dan
+# MATRIX_MAX_CELLS). Elke waarde gaat met één bincount naar zijn roostercel; meerdere waarden
+# in een cel (bijvoorbeeld ensembleleden) worden gemiddeld en lege cellen zijn NaN
+def timeseries_matrix(df):
+    codes, series_ids = pd.factorize(df["series_id"], sort=True)
+    n = len(series_ids)
+    timestamps = df["timestamp"].values.view("int64")
+    values = df["value"].to_numpy(dtype=float)
     
-    params = {
-        "locationIds": ",".join(location_ids),
-        "parameterIds": ",".join(parameter_ids),
-        "documentFormat": "DD_JSON",
-        "omitMissing": "true"
+    order = np.lexsort((timestamps, codes))
+    steps = np.diff(timestamps[order])
+    steps = steps[(codes[order][1:] == codes[order][:-1]) & (steps > 0)]
+    step = int(np.median(steps)) if len(steps) else 3600 * 10**9
+    
+    start = timestamps.min()
+    span = timestamps.max() - start
+    rows = span // step + 1
+    if rows * n > MATRIX_MAX_CELLS:
+        step *= -(-(rows * n) // MATRIX_MAX_CELLS)
+        rows = span // step + 1
+    
+    valid = ~np.isnan(values)
+    cells = (timestamps[valid] - start) // step * n + codes[valid]
+    sums = np.bincount(cells, weights=values[valid], minlength=rows * n)
+    counts = np.bincount(cells, minlength=rows * n)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        matrix = (sums / counts).reshape(rows, n)
+    
+    times = (start + np.arange(rows, dtype=np.int64) * step).astype("datetime64[ns]")
+    return {"times": times, "series_ids": list(series_ids), "values": matrix}
+
+def build_matrix_figure(matrix, query_key=None):
+    cache_key = (query_key, "matrix", matrix["values"].shape, float(np.nansum(matrix["values"]))) if query_key is not None else None
+    return cached_plot(cache_key, lambda: matrix_figure(matrix))
+
+# Eén heatmap-trace: reeksen op de y-as, tijd op de x-as
+def matrix_figure(matrix):
+    trace = {
+        "type": "heatmap",
+        "x": matrix["times"],
+        "y": matrix["series_ids"],
+        "z": matrix["values"].T,
+        "colorscale": [[0, DELTARES_LIGHT_BLUE], [0.5, DELTARES_BLUE], [1, DELTARES_DARK_BLUE]],
+        "colorbar": {"title": {"text": "Waarde"}},
+        "hoverongaps": False
+    }
+    layout = {
+        "title": {"text": f"Matrix van {len(matrix['series_ids'])} tijdseries", "font": {"size": 18, "color": DELTARES_BLACK}},
+        "xaxis": {"title": {"text": "Datum"}},
+        "yaxis": {"title": {"text": "Locatie - Parameter"}, "automargin": True},
+        "font": {"family": "Roboto, Arial, sans-serif"},
+        "plot_bgcolor": DELTARES_WHITE,
+        "paper_bgcolor": DELTARES_WHITE,
+        "height": min(max(450, 15 * len(matrix["series_ids"]) + 150), 2000),
+        "margin": {"l": 50, "r": 50, "t": 80, "b": 50}
     }
+    return go.Figure(data=[trace], layout=layout, _validate=False)
+
+# Correlatie tussen alle paren reeksen uit de matrix, over de tijdstippen waarop beide een
+# waarde hebben. Alle sommen per paar volgen uit een paar matrixvermenigvuldigingen
+def matrix_correlation(matrix):
+    values = matrix["values"]
+    present = (~np.isnan(values)).astype(float)
+    filled = np.where(present > 0, values, 0.0)
     
-    if start_date:
-        params["startTime"] = start_date
-    if end_date:
-        params["endTime"] = end_date
+    overlap = present.T @ present
+    sum_x = filled.T @ present
+    sum_xx = (filled ** 2).T @ present
+    sum_xy = filled.T @ filled
+    with np.errstate(invalid="ignore", divide="ignore"):
+        covariance = overlap * sum_xy - sum_x * sum_x.T
+        variance = (overlap * sum_xx - sum_x ** 2) * (overlap * sum_xx - sum_x ** 2).T
+        correlation = np.clip(covariance / np.sqrt(variance), -1, 1)
+    correlation[overlap < MIN_CORRELATION_OVERLAP] = np.nan
+    return correlation, overlap
+
+def correlation_figure(matrix, correlation):
+    trace = {
+        "type": "heatmap",
+        "x": matrix["series_ids"],
+        "y": matrix["series_ids"],
+        "z": correlation,
+        "zmin": -1,
+        "zmax": 1,
+        "colorscale": "RdBu",
+        "colorbar": {"title": {"text": "Correlatie"}},
+        "hoverongaps": False
+    }
+    layout = {
+        "title": {"text": "Correlatie tussen de tijdseries", "font": {"size": 18, "color": DELTARES_BLACK}},
+        "xaxis": {"automargin": True},
+        "yaxis": {"automargin": True, "autorange": "reversed"},
+        "font": {"family": "Roboto, Arial, sans-serif"},
+        "plot_bgcolor": DELTARES_WHITE,
+        "paper_bgcolor": DELTARES_WHITE,
+        "height": min(max(450, 15 * len(matrix["series_ids"]) + 150), 2000)
+    }
+    return go.Figure(data=[trace], layout=layout, _validate=False)
+
+# De sterkst (positief of negatief) gecorreleerde paren
+def strongest_correlations(matrix, correlation, overlap, limit=20):
+    first, second = np.triu_indices(len(matrix["series_ids"]), k=1)
+    values = correlation[first, second]
+    keep = ~np.isnan(values)
+    first, second, values = first[keep], second[keep], values[keep]
+    top = np.argsort(-np.abs(values))[:limit]
+    series_ids = np.array(matrix["series_ids"], dtype=object)
+    return pd.DataFrame({
+        "reeks A": series_ids[first[top]],
+        "reeks B": series_ids[second[top]],
+        "correlatie": np.round(values[top], 3),
+        "gemeenschappelijke tijdstippen": overlap[first[top], second[top]].astype(int)
+    })
+
+# Afwijkende reeksen uit de vergelijking: A als doorgetrokken, B als gestreepte lijn. De reeksen
+# met de meeste ontbrekende events en de grootste verschillen komen eerst
+def comparison_figure(df_a, df_b, comparison, names=("A", "B")):
+    stats = comparison["stats"]
+    divergent = stats[stats["afwijkend"]]
+    divergent = divergent.assign(
+        missing=divergent["ontbreekt in A"] + divergent["ontbreekt in B"]
+    ).sort_values(["missing", "max. abs. verschil"], ascending=False).head(COMPARE_MAX_PLOTTED)
     
-    try:
-        endpoints = get_endpoints(api_url)
-        request_url = f"{endpoints['base_url']}{endpoints['timeseries_endpoint']}"
-        print(f"Request URL: {request_url}")
-        print(f"Request parameters: {params}")
-        response = requests.get(request_url, params=params)
-        print(f"Status code: {response.status_code}")
-        
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Request fout: {str(e)}")
-        return {"error": f"Request fout: {str(e)}"}
-    except json.JSONDecodeError as e:
-        print(f"JSON decode fout: {str(e)}")
-        return {"error": f"JSON decodering mislukt: {str(e)}"}
-    except Exception as e:
-        print(f"Algemene fout: {str(e)}")
-        return {"error": str(e)}
+    traces = []
+    for i, (key, row) in enumerate(divergent.iterrows()):
+        color = FIGURE_COLORS[i % len(FIGURE_COLORS)]
+        label = f"{row['reeks']} ({row['lid']})" if row["lid"] else row["reeks"]
+        for df, keys, name, dash in ((df_a, comparison["key_a"], names[0], "solid"), (df_b, comparison["key_b"], names[1], "dash")):
+            mask = keys == key
+            if not mask.any():
+                continue
+            order = np.argsort(df["timestamp"].values[mask], kind="stable")
+            traces.append({
+                "type": "scattergl",
+                "name": f"{label} - {name}",
+                "legendgroup": label,
+                "x": df["timestamp"].values[mask][order],
+                "y": df["value"].to_numpy(dtype=float)[mask][order],
+                "mode": "lines+markers",
+                "line": {"color": color, "dash": dash},
+                "marker": {"color": color, "size": 4}
+            })
+    
+    grid = {"showgrid": True, "gridwidth": 0.5, "gridcolor": "rgba(0,0,0,0.1)"}
+    layout = {
+        "title": {"text": f"Afwijkende reeksen ({len(divergent)} van {int(stats['afwijkend'].sum())})",
+                  "font": {"size": 18, "color": DELTARES_BLACK}},
+        "xaxis": {"title": {"text": "Datum"}, **grid},
+        "yaxis": {"title": {"text": "Waarde"}, **grid},
+        "hovermode": "x unified",
+        "font": {"family": "Roboto, Arial, sans-serif"},
+        "plot_bgcolor": DELTARES_WHITE,
+        "paper_bgcolor": DELTARES_WHITE,
+        "legend": {"font": {"size": 10}},
+        "margin": {"l": 50, "r": 150, "t": 80, "b": 50}
+    }
+    return go.Figure(data=traces, layout=layout, _validate=False)
 
 # UI functies
 def fetch_locations(api_url):
     if not api_url:
         return "Vul eerst een geldige API URL in", None, []
     
-    data = get_locations(api_url)
-    if "error" in data:
-        return f"Fout bij het ophalen van locaties: {data['error']}", None, []
-    
-    # Verwerk de PI_JSON formaat van locaties
-    locations = []
-    location_options = []
-    unique_ids = set()  # Set voor het bijhouden van unieke IDs
-    
-    # Controleer of we het verwachte formaat hebben
-    if "locations" in data:
-        for location in data.get("locations", []):
-            # Haal ID op
-            location_id = location.get("locationId", "Onbekend")
-            location_name = location.get("description", location.get("shortName", "Onbekend"))
-            
-            # Alle beschikbare velden uit de locatie toevoegen
-            location_data = {
-                "id": location_id,
-                "name": location_name,
-                "shortName": location.get("shortName", ""),
-                "lat": location.get("lat", ""),
-                "lon": location.get("lon", ""),
-                "x": location.get("x", ""),
-                "y": location.get("y", ""),
-                "z": location.get("z", "")
-            }
-            
-            # Attributen toevoegen als die beschikbaar zijn
-            if "attributes" in location and location["attributes"]:
-                for i, attr in enumerate(location["attributes"]):
-                    if "id" in attr and "text" in attr:
-                        location_data[f"attr_{attr['id']}"] = attr["text"]
-            
-            locations.append(location_data)
-            unique_ids.add(location_id)
-            
-            # Voeg alleen ID toe aan dropdown-opties (zonder naam)
-            location_options.append(location_id)
+    catalog = get_cached_catalog("locations", api_url, load_location_catalog)
+    if "error" in catalog:
+        return f"Fout bij het ophalen van locaties: {catalog['error']}", None, []
     
-    if not locations:
+    locations_df = catalog["locations"]
+    if locations_df is None:
         return "Geen locaties gevonden", None, []
     
-    # Beperk tot eerste 5 opties
-    limited_location_options = location_options[:5]
+    # Voeg alleen ID toe aan dropdown-opties (zonder naam), beperkt tot de eerste 5 opties
+    limited_location_options = locations_df["id"].tolist()[:5]
     
-    locations_df = pd.DataFrame(locations)
-    return f"{len(unique_ids)} unieke locaties gevonden uit {len(locations)} items (eerste 5 getoond)", locations_df, limited_location_options
+    return f"{locations_df['id'].nunique()} unieke locaties gevonden uit {len(locations_df)} items (eerste 5 getoond)", locations_df, limited_location_options
 
 def fetch_parameters(api_url):
     if not api_url:
         return "Vul eerst een geldige API URL in", None, []
     
-    data = get_parameters(api_url)
+    data = get_cached_catalog("parameters", api_url, get_parameters)
     if "error" in data:
         return f"Fout bij het ophalen van parameters: {data['error']}", None, []
     
-    # Verwerk de PI_JSON formaat van parameters
-    parameters = []
-    parameter_options = []
-    unique_ids = set()  # Set voor het bijhouden van unieke IDs
-    
-    # Controleer of we het verwachte formaat hebben
-    if "timeSeriesParameters" in data:
-        for parameter in data.get("timeSeriesParameters", []):
-            # Haal ID op
-            parameter_id = parameter.get("id", "Onbekend")
-            parameter_name = parameter.get("name", "Onbekend")
-            
-            # Alle beschikbare velden uit de parameter toevoegen
-            param_data = {
-                "id": parameter_id,
-                "name": parameter_name,
-                "shortName": parameter.get("shortName", ""),
-                "unit": parameter.get("unit", ""),
-                "displayUnit": parameter.get("displayUnit", ""),
-                "parameterType": parameter.get("parameterType", ""),
-                "parameterGroup": parameter.get("parameterGroup", ""),
-                "parameterGroupName": parameter.get("parameterGroupName", ""),
-                "usesDatum": parameter.get("usesDatum", "")
-            }
-            parameters.append(param_data)
-            unique_ids.add(parameter_id)
-            
-            # Voeg alleen ID toe aan dropdown-opties (zonder naam)
-            parameter_options.append(parameter_id)
-    
-    if not parameters:
+    with profile_stage("DataFrame"):
+        params_df = parameters_to_dataframe(data)
+    if params_df is None:
         return "Geen parameters gevonden", None, []
     
-    # Beperk tot eerste 5 opties
-    limited_parameter_options = parameter_options[:5]
+    # Voeg alleen ID toe aan dropdown-opties (zonder naam), beperkt tot de eerste 5 opties
+    limited_parameter_options = params_df["id"].tolist()[:5]
     
-    params_df = pd.DataFrame(parameters)
-    return f"{len(unique_ids)} unieke parameters gevonden uit {len(parameters)} items (eerste 5 getoond)", params_df, limited_parameter_options
+    return f"{params_df['id'].nunique()} unieke parameters gevonden uit {len(params_df)} items (eerste 5 getoond)", params_df, limited_parameter_options
 
-def fetch_timeseries(api_url, location_ids, parameter_ids, start_date, end_date):
+@profiled
+def fetch_timeseries(api_url, location_ids, parameter_ids, start_date, end_date, result=None, aggregation="Ruw", markers=True, plot_type="Lijnen", request: gr.Request = None):
     if not api_url:
-        return "Vul eerst een geldige API URL in", None, None
+        yield "Vul eerst een geldige API URL in", *EMPTY_TABLE, None, gr.skip()
+        return
         
     if not location_ids or not parameter_ids:
-        return "Selecteer tenminste één locatie en parameter", None, None
+        yield "Selecteer tenminste één locatie en parameter", *EMPTY_TABLE, None, gr.skip()
+        return
     
     # Formateer datums correct
     if start_date:
         try:
-            start_date = datetime.strptime(start_date, "%Y-%m-%d").strftime("%Y-%m-%dT%H:%M:%SZ")
+            start_date = format_date(start_date)
         except ValueError:
-            return f"Ongeldige startdatum format: {start_date}. Gebruik YYYY-MM-DD.", None, None
+            yield f"Ongeldige startdatum format: {start_date}. Gebruik YYYY-MM-DD.", *EMPTY_TABLE, None, gr.skip()
+            return
     
     if end_date:
         try:
-            end_date = datetime.strptime(end_date, "%Y-%m-%d").strftime("%Y-%m-%dT%H:%M:%SZ")
+            end_date = format_date(end_date)
         except ValueError:
-            return f"Ongeldige einddatum format: {end_date}. Gebruik YYYY-MM-DD.", None, None
+            yield f"Ongeldige einddatum format: {end_date}. Gebruik YYYY-MM-DD.", *EMPTY_TABLE, None, gr.skip()
+            return
     
-    data = get_timeseries(api_url, location_ids, parameter_ids, start_date, end_date)
+    # Valt de opvraging binnen het resultaat dat de sessie al heeft, dan is geen nieuw
+    # verzoek aan de webservice nodig
+    if result_covers(result, api_url, location_ids, parameter_ids, start_date, end_date):
+        result = restore_result(result)
+    if result_covers(result, api_url, location_ids, parameter_ids, start_date, end_date):
+        selection = (tuple(location_ids), tuple(parameter_ids), start_date or None, end_date or None)
+        *outputs, result = render_timeseries({**result, "selection": selection}, aggregation, markers, plot_type)
+        status = (f"Tijdseries getoond uit het eerder opgehaalde resultaat ({len(result['view_df'])} events), "
+                  f"zonder nieuw verzoek aan de webservice")
+        result, note = hold_result(result)
+        if note:
+            status += f". {note}"
+        yield status, *outputs, result
+        return
     
-    if "error" in data:
-        return f"Fout bij het ophalen van tijdseries: {data['error']}", None, None
+    # Een nieuwe opvraging annuleert de nog lopende opvraging van dezelfde sessie
+    session_id = request.session_hash if request is not None else None
+    cancel_event = start_session_query(session_id)
+    # Het vorige resultaat van de sessie wordt vervangen en telt daarom als vrij
+    in_flight = InFlightMemory([("sessieresultaten", session_id)])
+    try:
+        yield from stream_timeseries(api_url, location_ids, parameter_ids, start_date, end_date, cancel_event, aggregation, markers, plot_type, session_id, in_flight)
+    finally:
+        in_flight.release()
+        finish_session_query(session_id, cancel_event)
+
+def stream_timeseries(api_url, location_ids, parameter_ids, start_date, end_date, cancel_event, aggregation="Ruw", markers=True, plot_type="Lijnen", session_id=None, in_flight=None):
+    in_flight = in_flight or InFlightMemory()
+    yield "Omvang van de opvraging schatten...", *SKIP_TABLE, gr.skip(), gr.skip()
+    sub_requests, warning = prepare_timeseries_requests(api_url, location_ids, parameter_ids, start_date, end_date)
+    if not sub_requests:
+        yield "Geen gegevens gevonden in de tijdseries", *EMPTY_TABLE, None, None
+        return
     
-    # Verwerk de DD_JSON formaat van tijdseries
-    all_series = []
+    total = len(sub_requests)
+    chunks = []
+    errors = []
+    event_count = 0
+    started = time.time()
+    last_update = 0
     
-    # Controleer of we het verwachte formaat hebben
-    if "results" in data:
-        for result in data.get("results", []):
-            if "events" not in result:
-                continue
-                
-            # Haal locatie en parameter informatie op
-            location_id = "Onbekend"
-            parameter_id = "Onbekend"
-            
-            if "location" in result and "properties" in result["location"]:
-                location_id = result["location"]["properties"].get("locationId", "Onbekend")
-                
-            if "observationType" in result:
-                parameter_id = result["observationType"].get("parameterCode", "Onbekend")
-            
-            # Verwerk events
-            for event in result.get("events", []):
-                all_series.append({
-                    "locationId": location_id,
-                    "parameterId": parameter_id,
-                    "timestamp": event.get("timeStamp", ""),
-                    "value": event.get("value", None)
-                })
+    # Toon tussenresultaten zodra deelverzoeken binnenkomen
+    for done, (error, chunk_df) in enumerate(iter_timeseries_chunks(api_url, sub_requests, cancel_event), start=1):
+        # Bij annulering de uitvoer laten staan; de status wordt door de annulering zelf gezet
+        if cancel_event.is_set():
+            yield gr.skip(), *SKIP_TABLE, gr.skip(), gr.skip()
+            return
+        
+        if error:
+            errors.append(error)
+        elif chunk_df is not None:
+            chunks.append(chunk_df)
+            event_count += len(chunk_df)
+            # Past het groeiende resultaat niet meer in het geheugenbudget, dan wordt de
+            # opvraging afgebroken
+            if not in_flight.add(chunk_df):
+                cancel_event.set()
+                yield in_flight.refusal(), *EMPTY_TABLE, None, gr.skip()
+                return
+        
+        if done == total:
+            break
+        
+        elapsed = time.time() - started
+        remaining = elapsed / done * (total - done)
+        status = (f"{done} van {total} deelverzoeken ontvangen, {event_count} events "
+                  f"(nog ongeveer {remaining:.0f} s)")
+        
+        # Grafiek en tabel worden niet vaker dan nodig opnieuw opgebouwd
+        if chunks and time.time() - last_update >= PROGRESS_UPDATE_INTERVAL:
+            last_update = time.time()
+            df = aggregate_timeseries(combine_timeseries_chunks(chunks), aggregation)
+            yield status, *table_outputs(df), build_view_figure(df, None, markers, plot_type)[0], gr.skip()
+        else:
+            yield status, *SKIP_TABLE, gr.skip(), gr.skip()
     
-    if not all_series:
-        return "Geen gegevens gevonden in de tijdseries", None, None
+    if errors and not chunks:
+        yield f"Fout bij het ophalen van tijdseries: {errors[0]}", *EMPTY_TABLE, None, None
+        return
     
-    df = pd.DataFrame(all_series)
-    df["timestamp"] = pd.to_datetime(df["timestamp"])
-    df["value"] = pd.to_numeric(df["value"], errors="coerce")
+    df = combine_timeseries_chunks(chunks)
+    if df is None:
+        yield "Geen gegevens gevonden in de tijdseries", *EMPTY_TABLE, None, None
+        return
     
-    # Sorteer de data chronologisch op timestamp
-    df = df.sort_values(by="timestamp")
+    # Bewaar het resultaat in de sessie, zodat weergave-opties, bladeren en de live modus er
+    # zonder nieuw verzoek mee verder kunnen en ensembles als 2-D arrays (tijd x lid)
+    # beschikbaar blijven. Alleen een volledig resultaat kan latere opvragingen afdekken
+    covered = None
+    if not errors:
+        covered_start = start_date or None
+        if warning:
+            # Het resultaat is ingekort tot de meest recente periode
+            covered_start = min(sub_request["start_date"] for sub_request in sub_requests)
+        covered = {
+            "endpoint": endpoint_key(api_url),
+            "location_ids": list(location_ids),
+            "parameter_ids": list(parameter_ids),
+            "start_date": covered_start,
+            "end_date": end_date or None,
+            "fetched": time.time()
+        }
+    result = {
+        "api_url": api_url,
+        "session": session_id,
+        "df": df,
+        "query_key": timeseries_query_key(api_url, location_ids, parameter_ids, start_date, end_date),
+        "ensembles": ensemble_arrays(df),
+        "covered": covered,
+        "selection": None
+    }
+    *outputs, result = render_timeseries(result, aggregation, markers, plot_type)
     
-    # Maak een unieke legenda-identifier per combinatie van locatie en parameter
-    df["series_id"] = df["locationId"] + " - " + df["parameterId"]
+    status = f"Tijdseries gevonden voor de geselecteerde criteria ({len(df)} events in {time.time() - started:.1f} s)"
+    if errors:
+        status += f". Let op: {len(errors)} van {total} deelverzoeken mislukt: {errors[0]}"
+    if warning:
+        status += f". {warning}"
+    # De boeking van de lopende opvraging gaat over op het bewaarde resultaat
+    in_flight.release()
+    result, note = hold_result(result)
+    if note:
+        status += f". {note}"
+    yield status, *outputs, result
+
+# Controleer goedkoop of een opvraging binnen het bewaarde resultaat valt: dezelfde
+# webservice, een deelverzameling van de locaties en parameters en een periode binnen de
+# opgehaalde periode (zonder begindatum is alle beschikbare data opgehaald). Voor een opvraging
+# die verder loopt dan het moment van ophalen is het resultaat maar OPEN_PERIOD_MAX_AGE
+# seconden actueel
+def result_covers(result, api_url, location_ids, parameter_ids, start_date, end_date):
+    covered = result.get("covered") if result else None
+    if not covered or (result.get("df") is None and not result.get("spilled")):
+        return False
+    if covered["endpoint"] != endpoint_key(api_url):
+        return False
+    if not set(location_ids) <= set(covered["location_ids"]) or not set(parameter_ids) <= set(covered["parameter_ids"]):
+        return False
+    if covered["start_date"] and (not start_date or start_date < covered["start_date"]):
+        return False
+    if covered["end_date"] and (not end_date or end_date > covered["end_date"]):
+        return False
+    fetched = covered.get("fetched", 0)
+    if period_is_open(end_date, fetched) and time.time() - fetched > OPEN_PERIOD_MAX_AGE:
+        return False
+    return True
+
+# Weergave van het bewaarde resultaat: de selectie (locaties, parameters, periode) van een
+# lokaal afgehandelde opvraging, eventueel geaggregeerd
+def timeseries_view(result, aggregation):
+    df = result["df"]
+    if result["selection"] is not None:
+        df = select_timeseries(df, *result["selection"])
+    return aggregate_timeseries(df, aggregation)
+
+# Gemiddelde per reeks (en ensemblelid) per uur of dag
+def aggregate_timeseries(df, aggregation):
+    freq = AGGREGATIONS.get(aggregation)
+    if df is None or freq is None or df.empty:
+        return df
+    with profile_stage("DataFrame"):
+        keys = [df["series_id"], df["locationId"], df["parameterId"], df["member"], df["timestamp"].dt.floor(freq)]
+        aggregated = df["value"].groupby(keys, dropna=False, sort=False, observed=True).mean().reset_index()
+        aggregated.columns = ["series_id", "locationId", "parameterId", "member", "timestamp", "value"]
+        # Leden zonder waarde blijven leeg in plaats van NaN
+        aggregated["member"] = aggregated["member"].astype(object).where(aggregated["member"].notna(), None)
+        return aggregated[TIMESERIES_COLUMNS].sort_values(by="timestamp")
+
+# Tabel en grafiek opnieuw opbouwen uit het bewaarde resultaat
+def render_timeseries(result, aggregation, markers, plot_type="Lijnen"):
+    view_df = timeseries_view(result, aggregation)
+    result = {**result, "view_df": view_df, "matrix": None}
+    if view_df.empty:
+        return (*EMPTY_TABLE, None, result)
+    
+    gaps = detect_gaps(view_df, *result_period(result))
+    # De ensemble-arrays van het volledige resultaat zijn alleen bruikbaar voor de ongewijzigde weergave
+    unchanged = result["selection"] is None and AGGREGATIONS.get(aggregation) is None
+    figure_key = (result["query_key"], result["selection"], aggregation)
+    fig, result["matrix"] = build_view_figure(view_df, figure_key, markers, plot_type,
+                                              ensembles=result["ensembles"] if unchanged else None, gaps=gaps)
+    return (*table_outputs(view_df, gaps=gaps), fig, result)
+
+# Periode van de weergave (begin, eind) voor de gatenanalyse; None als die open is
+def result_period(result):
+    if result["selection"] is not None:
+        return result["selection"][2], result["selection"][3]
+    covered = result.get("covered") or {}
+    return covered.get("start_date"), covered.get("end_date")
+
+# Grafiek van de weergave: lijnen per reeks of één matrix (heatmap). De matrix wordt
+# teruggegeven, zodat de correlatie hem kan hergebruiken
+def build_view_figure(df, figure_key, markers, plot_type, ensembles=None, gaps=None):
+    if plot_type == "Matrix":
+        matrix = timeseries_matrix(df)
+        return build_matrix_figure(matrix, figure_key), matrix
+    return build_timeseries_figure(df, figure_key, markers=markers, ensembles=ensembles, gaps=gaps), None
+
+# Correlatie tussen de reeksen van de huidige weergave, uit dezelfde matrix als de matrixweergave
+def show_correlation(result):
+    result = restore_result(result)
+    if not result or result.get("view_df") is None or result["view_df"].empty:
+        return None, None, gr.skip()
+    matrix = result.get("matrix")
+    if matrix is None:
+        with profile_stage("DataFrame"):
+            matrix = timeseries_matrix(result["view_df"])
+        result = {**result, "matrix": matrix}
+    correlation, overlap = matrix_correlation(matrix)
+    fig = cached_plot(None, lambda: correlation_figure(matrix, correlation))
+    return fig, strongest_correlations(matrix, correlation, overlap), hold_result(result)[0]
+
+# Weergave-opties: tabel en grafiek opnieuw opbouwen zonder verzoek aan de webservice
+def update_view(result, aggregation, markers, plot_type="Lijnen"):
+    result = restore_result(result)
+    if not result or result.get("df") is None:
+        return gr.skip(), *SKIP_TABLE, gr.skip(), gr.skip()
+    *outputs, result = render_timeseries(result, aggregation, markers, plot_type)
+    status = f"Weergave bijgewerkt ({len(result['view_df'])} events)"
+    result, note = hold_result(result)
+    if note:
+        status += f". {note}"
+    return status, *outputs, result
+
+# Geheugenlimiet per sessie en voor het hele proces: een resultaat dat te groot is of niet
+# meer in het geheugenbudget past, wordt na het tonen naar schijf geschreven. De sessie houdt
+# dan alleen de verwijzing naar de bestanden
+def result_memory(result):
+    size = frame_memory(result["df"])
+    if result.get("view_df") is not None and result["view_df"] is not result["df"]:
+        size += frame_memory(result["view_df"])
+    size += sum(ensemble["values"].nbytes for ensemble in result["ensembles"].values())
+    if result.get("matrix") is not None:
+        size += result["matrix"]["values"].nbytes
+    return size
+
+def hold_result(result):
+    size = result_memory(result)
+    if size <= SESSION_RESULT_MAX_MB * 1024 * 1024 and reserve_memory("sessieresultaten", result.get("session"), size):
+        remove_spill_files(result.get("session"))
+        return result, None
+    
+    release_memory("sessieresultaten", result.get("session"))
+    try:
+        with profile_stage("schijf (sessieresultaat)"):
+            result = spill_result(result)
+    except OSError as e:
+        return None, (f"Het resultaat ({size / (1024 * 1024):.0f} MB) past niet in het geheugen van de app en kon niet "
+                      f"naar schijf worden geschreven ({e}); bladeren, weergave-opties en live volgen vragen een nieuwe opvraging")
+    record_metric("spilled_results")
+    return result, (f"Het resultaat ({size / (1024 * 1024):.0f} MB) past niet in het geheugen van de app en is naar "
+                    f"schijf geschreven; bladeren en weergave-opties lezen het daar weer in")
+
+# Bestanden voor het resultaat van een sessie in SPILL_DIR: het volledige resultaat en de weergave
+def spill_paths(session_id):
+    name = hashlib.sha256(str(session_id).encode()).hexdigest()[:16]
+    return {"df": os.path.join(SPILL_DIR, f"{name}.arrow"), "view": os.path.join(SPILL_DIR, f"{name}-weergave.arrow")}
+
+def spill_result(result):
+    os.makedirs(SPILL_DIR, exist_ok=True)
+    paths = spill_paths(result.get("session"))
+    write_arrow_file(paths["df"], result["df"])
+    if result.get("view_df") is not None and result["view_df"] is not result["df"]:
+        write_arrow_file(paths["view"], result["view_df"])
+    else:
+        remove_file(paths["view"])
+        paths["view"] = paths["df"]
+    return {**result, "df": None, "view_df": None, "ensembles": None, "matrix": None, "spilled": paths}
+
+# Lees een naar schijf geschreven resultaat weer in; None als de bestanden er niet meer zijn
+def restore_result(result):
+    if not result or not result.get("spilled"):
+        return result
+    try:
+        with profile_stage("schijf (sessieresultaat)"):
+            df = read_arrow_file(result["spilled"]["df"]).to_pandas()
+            if result["spilled"]["view"] == result["spilled"]["df"]:
+                view_df = df
+            else:
+                view_df = read_arrow_file(result["spilled"]["view"]).to_pandas()
+    except OSError:
+        return None
+    return {**result, "df": df, "view_df": view_df, "ensembles": ensemble_arrays(df), "spilled": None}
+
+def write_arrow_file(path, df):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    temp_path = f"{path}.tmp"
+    with pa.OSFile(temp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temp_path, path)
+
+# Het bestand wordt gemapt, zodat alleen de gelezen delen (bijvoorbeeld één tabelpagina) in
+# het geheugen komen
+def read_arrow_file(path):
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def remove_spill_files(session_id):
+    for path in spill_paths(session_id).values():
+        remove_file(path)
+
+# Opruimen bij het einde van een sessie (delete_callback van de sessiestatus)
+def release_result(result):
+    if result:
+        release_memory("sessieresultaten", result.get("session"))
+        remove_spill_files(result.get("session"))
+
+
+# Live modus: voeg nieuwe events toe aan het resultaat van de sessie
+def poll_live_timeseries(result, aggregation="Ruw", markers=True, plot_type="Lijnen"):
+    result = restore_result(result)
+    if not result or result.get("df") is None:
+        return gr.skip(), *SKIP_TABLE, gr.skip(), gr.skip()
     
-    # Deltares kleurenpalet voor de plot
-    deltares_colors = [
-        DELTARES_BLUE, DELTARES_DARK_BLUE, DELTARES_LIGHT_BLUE, 
-        "#5DACDB", "#8ABCDB", "#B9D9ED"  # Extra lichtblauwe tinten
+    df = result["df"]
+    members = df["member"].astype(object).fillna("")
+    series_last = df.groupby([df["locationId"], df["parameterId"], members], observed=True)["timestamp"].max().to_dict()
+    error, new_events = poll_live_events(result["api_url"], series_last)
+    checked = datetime.now().strftime("%H:%M:%S")
+    if error:
+        return f"Live: fout bij het ophalen van nieuwe events ({checked}): {error}", *SKIP_TABLE, gr.skip(), gr.skip()
+    if new_events is None:
+        return f"Live: geen nieuwe events (laatste controle {checked})", *SKIP_TABLE, gr.skip(), gr.skip()
+    
+    df = pd.concat([df, new_events], ignore_index=True).sort_values(by="timestamp")
+    result = {**result, "df": df, "ensembles": ensemble_arrays(df)}
+    *outputs, result = render_timeseries(result, aggregation, markers, plot_type)
+    status = f"Live: {len(new_events)} nieuwe events toegevoegd (laatste controle {checked}), totaal {len(df)} events"
+    result, note = hold_result(result)
+    if note:
+        status += f". {note}"
+    return status, *outputs, result
+
+# Tabelweergave: blader door de pagina's van de huidige weergave
+def show_table_page(result, page):
+    # Van een naar schijf geschreven resultaat wordt alleen de gevraagde pagina ingelezen
+    if result and result.get("spilled"):
+        try:
+            return timeseries_page(read_arrow_file(result["spilled"]["view"]), page)
+        except OSError:
+            return gr.skip(), gr.skip(), gr.skip()
+    if not result or result.get("view_df") is None:
+        return gr.skip(), gr.skip(), gr.skip()
+    return timeseries_page(result["view_df"], page)
+
+def previous_table_page(result, page):
+    return show_table_page(result, (page or 1) - 1)
+
+def next_table_page(result, page):
+    return show_table_page(result, (page or 1) + 1)
+
+def toggle_live(enabled):
+    return gr.Timer(active=enabled)
+
+# Beheerpaneel: profilering aan/uit zetten en opgenomen profielen bekijken en downloaden
+def set_profiling(enabled):
+    if not ADMIN_PANEL:
+        return
+    if enabled:
+        _profiling_enabled.set()
+    else:
+        _profiling_enabled.clear()
+
+def list_profiles():
+    if not ADMIN_PANEL:
+        return None, gr.update(choices=[], value=None)
+    with _profiles_lock:
+        profiles = list(_profiles)
+    rows = [
+        {
+            "profiel": profile.id,
+            "functie": profile.name,
+            "gestart": datetime.fromtimestamp(profile.started).strftime("%Y-%m-%d %H:%M:%S"),
+            "totaal (s)": round(profile.wall_time, 3)
+        }
+        for profile in reversed(profiles)
     ]
+    choices = [row["profiel"] for row in rows]
+    return pd.DataFrame(rows, columns=["profiel", "functie", "gestart", "totaal (s)"]), gr.update(choices=choices, value=choices[0] if choices else None)
+
+def show_profile(profile_id):
+    if not ADMIN_PANEL:
+        return None, None
+    with _profiles_lock:
+        profile = next((profile for profile in _profiles if profile.id == profile_id), None)
+    if profile is None:
+        return None, None
     
-    # Maak één enkele plot met aparte lijnen voor elke unieke combinatie
-    fig = px.line(df, x="timestamp", y="value", color="series_id", 
-                 title=f"Tijdseries voor alle locatie-parameter combinaties",
-                 color_discrete_sequence=deltares_colors)
-    
-    # Voeg markers toe voor elke meting
-    fig.update_traces(mode='lines+markers', marker=dict(size=6))
-    
-    # Update layout
-    fig.update_layout(
-        xaxis_title="Datum",
-        yaxis_title="Waarde",
-        legend_title="Locatie - Parameter",
-        hovermode="x unified",  # Alle waardes tonen bij hover op dezelfde x-positie
-        font=dict(family="Roboto, Arial, sans-serif"),
-        plot_bgcolor=DELTARES_WHITE,
-        paper_bgcolor=DELTARES_WHITE,
-        title_font=dict(size=18, color=DELTARES_BLACK),
-        legend=dict(
-            orientation="v",
-            yanchor="top",
-            y=0.99,
-            xanchor="left",
-            x=1.02,
-            title_font=dict(size=12),
-            font=dict(size=10)
-        ),
-        margin=dict(l=50, r=150, t=80, b=50)
+    # Fasen van parallelle deelverzoeken tellen op en kunnen samen langer duren dan het totaal
+    stages = pd.DataFrame(
+        [
+            {"fase": stage, "tijd (s)": round(total, 3), "aantal": count, "aandeel van totaal (%)": round(100 * total / profile.wall_time, 1)}
+            for stage, (total, count) in sorted(profile.stages.items(), key=lambda item: -item[1][0])
+        ],
+        columns=["fase", "tijd (s)", "aantal", "aandeel van totaal (%)"]
     )
     
-    # Update axes
-    fig.update_xaxes(showgrid=True, gridwidth=0.5, gridcolor='rgba(0,0,0,0.1)')
-    fig.update_yaxes(showgrid=True, gridwidth=0.5, gridcolor='rgba(0,0,0,0.1)')
+    path = os.path.join(tempfile.gettempdir(), f"profiel-{profile.id}.speedscope.json")
+    with open(path, "w") as f:
+        json.dump(profile.to_speedscope(), f)
+    return stages, path
+
+# Batch-opvragingen: verzamel selecties en haal ze samen op met gedeelde verzoeken
+BATCH_COLUMNS = ["opvraging", "locaties", "parameters", "startdatum", "einddatum"]
+
+def batch_queue_table(queue):
+    return pd.DataFrame(
+        [
+            [i, ", ".join(query["location_ids"]), ", ".join(query["parameter_ids"]), query["start_date"] or "", query["end_date"] or ""]
+            for i, query in enumerate(queue, start=1)
+        ],
+        columns=BATCH_COLUMNS
+    )
+
+def add_batch_query(queue, location_ids, parameter_ids, start_date, end_date):
+    if not location_ids or not parameter_ids:
+        return gr.skip(), gr.skip(), "Selecteer tenminste één locatie en parameter"
+    try:
+        start_date = format_date(start_date) if start_date else None
+        end_date = format_date(end_date) if end_date else None
+    except ValueError:
+        return gr.skip(), gr.skip(), "Ongeldig datumformaat. Gebruik YYYY-MM-DD."
     
-    return f"Tijdseries gevonden voor de geselecteerde criteria", df, fig
+    queue = (queue or []) + [{
+        "location_ids": list(location_ids),
+        "parameter_ids": list(parameter_ids),
+        "start_date": start_date,
+        "end_date": end_date
+    }]
+    return queue, batch_queue_table(queue), f"{len(queue)} opvragingen in de batch"
 
-# Functie om locaties en parameters op te halen na het invoeren van een URL
-def update_api_url(api_url):
+def clear_batch():
+    return [], batch_queue_table([]), "Batch leeggemaakt"
+
+def run_batch(api_url, queue):
     if not api_url:
-        api_url = DEFAULT_API_URL
+        return "Vul eerst een geldige API URL in", None, None
+    if not queue:
+        return "Voeg eerst opvragingen aan de batch toe", None, None
     
-    # Verwijder eventuele slash aan het einde
-    if api_url.endswith('/'):
-        api_url = api_url[:-1]
+    results, batch_requests, errors, warnings_ = fetch_timeseries_batch(api_url, queue)
+    if errors and all(result is None for result in results):
+        return f"Fout bij het ophalen van de batch: {errors[0]}", None, None
     
-    # Poging om te veranderen naar een REST endpoint als het nog niet is gespecificeerd
-    if not ("/rest/fewspiservice/v1" in api_url):
-        endpoints = get_endpoints(api_url)
-        api_url = f"{endpoints['base_url']}{endpoints['rest_endpoint']}"
+    overview = batch_queue_table(queue)
+    overview["events"] = [len(result) if result is not None else 0 for result in results]
+    overview["reeksen"] = [result["series_id"].nunique() if result is not None else 0 for result in results]
+    
+    # Alle resultaten in één bestand, met het nummer van de opvraging per rij
+    frames = [result.assign(opvraging=i) for i, result in enumerate(results, start=1) if result is not None and not result.empty]
+    path = None
+    if frames:
+        path = os.path.join(tempfile.gettempdir(), f"batch-{int(time.time() * 1000)}.csv")
+        pd.concat(frames, ignore_index=True).to_csv(path, index=False)
+    
+    status = f"{len(queue)} opvragingen opgehaald met {len(batch_requests)} gedeelde, niet-overlappende verzoeken"
+    if errors:
+        status += f". Let op: {len(errors)} deelverzoeken mislukt: {errors[0]}"
+    if warnings_:
+        status += f". {warnings_[0]}"
+    return status, overview, path
+
+# Vergelijken: dezelfde selectie bij de webservice van de app (A) en een tweede webservice (B)
+@profiled
+def run_comparison(api_url_a, api_url_b, location_ids, parameter_ids, start_date, end_date):
+    if not api_url_a or not api_url_b:
+        return "Vul beide API URL's in", None, None
+    if not location_ids or not parameter_ids:
+        return "Selecteer tenminste één locatie en parameter", None, None
+    try:
+        query = {
+            "location_ids": list(location_ids),
+            "parameter_ids": list(parameter_ids),
+            "start_date": format_date(start_date) if start_date else None,
+            "end_date": format_date(end_date) if end_date else None
+        }
+    except ValueError:
+        return "Ongeldig datumformaat. Gebruik YYYY-MM-DD.", None, None
+    
+    started = time.perf_counter()
+    sides = fetch_comparison(normalize_api_url(api_url_a), normalize_api_url(api_url_b), query)
+    for name, (_, _, errors, _) in zip("AB", sides):
+        if errors:
+            return f"Fout bij het ophalen van {name}: {errors[0]}", None, None
+    df_a, df_b = sides[0][0][0], sides[1][0][0]
+    comparison = compare_timeseries(df_a, df_b)
+    stats = comparison["stats"]
+    
+    divergent = int(stats["afwijkend"].sum())
+    status = (f"{len(stats)} reeksen vergeleken in {time.perf_counter() - started:.1f} s: {divergent} wijken af. "
+              f"{int(stats['gekoppeld'].sum())} events gekoppeld, {int(stats['ontbreekt in A'].sum())} ontbreken in A, "
+              f"{int(stats['ontbreekt in B'].sum())} ontbreken in B")
+    if stats["max. abs. verschil"].notna().any():
+        status += f", grootste verschil {stats['max. abs. verschil'].max():.4g}"
+    warnings_ = sides[0][3] + sides[1][3]
+    if warnings_:
+        status += f". {warnings_[0]}"
+    
+    fig = None
+    if divergent:
+        fig = cached_plot(None, lambda: comparison_figure(df_a, df_b, comparison))
+    table = stats.sort_values(["afwijkend", "max. abs. verschil"], ascending=False, na_position="first")
+    return status, table, fig
+
+def cancel_timeseries(request: gr.Request = None):
+    if request is not None and cancel_session_query(request.session_hash):
+        return "Verzoek geannuleerd"
+    return "Er loopt geen verzoek om te annuleren"
+
+# Functie om locaties en parameters op te halen na het invoeren van een URL
+@profiled
+def update_api_url(api_url):
+    api_url = normalize_api_url(api_url)
     
     # Fetch locaties en parameters
     loc_status, loc_df, loc_options = fetch_locations(api_url)
     param_status, param_df, param_options = fetch_parameters(api_url)
+    attribute_choices = gr.update(choices=get_attribute_ids(api_url), value=None)
+    filter_choices = gr.update(choices=get_filter_choices(api_url), value=None)
+    
+    # Bouw op de achtergrond de beschikbaarheidsindex voor deze webservice op
+    start_availability_index(api_url)
+    
+    return api_url, loc_status, loc_df, loc_options, param_status, param_df, param_options, attribute_choices, filter_choices
+
+# Beperk de keuzes in de dropdowns tot combinaties die volgens de beschikbaarheidsindex
+# tijdseries hebben; zolang de index nog niet klaar is blijven de keuzes ongewijzigd
+def restrict_parameter_choices(api_url, location_ids):
+    parameter_ids = available_parameters(api_url, location_ids)
+    if parameter_ids is None:
+        return gr.skip()
+    return gr.update(choices=parameter_ids)
+
+def restrict_location_choices(api_url, parameter_ids):
+    location_ids = available_locations(api_url, parameter_ids)
+    if location_ids is None:
+        return gr.skip()
+    return gr.update(choices=location_ids)
+
+# Attribuut-IDs en -waarden uit de (gecachte) locatiecatalogus voor het attribuutfilter
+def get_attribute_ids(api_url):
+    catalog = get_cached_catalog("locations", api_url, load_location_catalog)
+    if "error" in catalog:
+        return []
+    return sorted({attr_id for attr_id, _ in catalog["attribute_index"]})
+
+def update_attribute_values(api_url, attr_id):
+    catalog = get_cached_catalog("locations", api_url, load_location_catalog)
+    if not attr_id or "error" in catalog:
+        return gr.update(choices=[], value=None)
+    values = sorted({value for key_id, value in catalog["attribute_index"] if key_id == attr_id})
+    return gr.update(choices=values, value=None)
+
+# Selecteer alle locaties met de gekozen attribuutwaarde in de locatie dropdown
+def select_locations_by_attribute(api_url, attr_id, value):
+    if not attr_id or not value:
+        return gr.skip()
+    catalog = get_cached_catalog("locations", api_url, load_location_catalog)
+    if "error" in catalog:
+        return gr.skip()
+    location_ids = find_locations_by_attribute(catalog, attr_id, value)
+    return gr.update(choices=location_ids, value=location_ids)
+
+# Filters van de webservice: een filter selecteert in één keer al zijn locaties
+def get_filter_choices(api_url):
+    catalog = get_cached_catalog("filters", api_url, load_filters)
+    if "error" in catalog:
+        return []
+    return [(f"{name} ({filter_id})" if name != filter_id else filter_id, filter_id) for filter_id, name in catalog["filters"]]
+
+def select_locations_by_filter(api_url, filter_id):
+    if not filter_id:
+        return gr.skip()
+    data = expand_filter(api_url, filter_id)
+    if "error" in data:
+        return gr.skip()
+    return gr.update(choices=data["location_ids"], value=data["location_ids"])
+
+# REST API die naast de UI wordt aangeboden, zodat andere tools de genormaliseerde
+# data als JSON of als Arrow IPC stream kunnen ophalen. Bij het opstarten worden de
+# catalogi van de standaard webservices op de achtergrond alvast opgehaald
+@asynccontextmanager
+async def lifespan(app):
+    start_catalog_warmup()
+    yield
+
+api = FastAPI(title="FEWS Webservices Explorer API", lifespan=lifespan)
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+def dataframe_response(df, output_format):
+    with profile_stage("serialisatie (REST)", {"fews.events": len(df), "fews.format": output_format}):
+        # Categorische kolommen als gewone tekst, zodat het antwoord niet van de schijfcache afhangt
+        df = plain_columns(df)
+        if output_format == "arrow":
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            body = sink.getvalue().to_pybytes()
+            media_type = ARROW_STREAM_MEDIA_TYPE
+        else:
+            body = df.to_json(orient="records", date_format="iso")
+            media_type = "application/json"
+        set_span_attributes({"fews.bytes": len(body)})
+        return Response(body, media_type=media_type)
+
+def split_ids(ids):
+    return [item.strip() for item in ids.split(",") if item.strip()]
+
+@api.get("/api/v1/locations")
+@traced
+def api_locations(
+    api_url: str = Query(DEFAULT_API_URL),
+    attribute_id: str = Query(None, alias="attributeId"),
+    attribute_value: str = Query(None, alias="attributeValue"),
+    output_format: Literal["json", "arrow"] = Query("json", alias="format")
+):
+    catalog = get_cached_catalog("locations", normalize_api_url(api_url), load_location_catalog)
+    if "error" in catalog:
+        return JSONResponse({"error": catalog["error"]}, status_code=502)
+    
+    df = catalog["locations"]
+    # Optioneel filteren op een attribuutwaarde via de omgekeerde index
+    if df is not None and attribute_id is not None:
+        df = df[df["id"].isin(find_locations_by_attribute(catalog, attribute_id, attribute_value))]
+    return dataframe_response(df if df is not None else pd.DataFrame(columns=["id", "name"]), output_format)
+
+@api.get("/api/v1/parameters")
+@traced
+def api_parameters(
+    api_url: str = Query(DEFAULT_API_URL),
+    output_format: Literal["json", "arrow"] = Query("json", alias="format")
+):
+    data = get_cached_catalog("parameters", normalize_api_url(api_url), get_parameters)
+    if "error" in data:
+        return JSONResponse({"error": data["error"]}, status_code=502)
+    
+    df = parameters_to_dataframe(data)
+    return dataframe_response(df if df is not None else pd.DataFrame(columns=["id", "name"]), output_format)
+
+@api.get("/api/v1/timeseries")
+@traced
+def api_timeseries(
+    location_ids: str = Query(None, alias="locationIds"),
+    parameter_ids: str = Query(..., alias="parameterIds"),
+    start_date: str = Query(None, alias="startDate"),
+    end_date: str = Query(None, alias="endDate"),
+    api_url: str = Query(DEFAULT_API_URL),
+    filter_id: str = Query(None, alias="filterId"),
+    output_format: Literal["json", "arrow"] = Query("json", alias="format")
+):
+    api_url = normalize_api_url(api_url)
+    location_ids = split_ids(location_ids) if location_ids else []
+    parameter_ids = split_ids(parameter_ids)
+    # Een filter wordt lokaal uitgeklapt naar zijn locaties
+    if filter_id:
+        data = expand_filter(api_url, filter_id)
+        if "error" in data:
+            return JSONResponse({"error": data["error"]}, status_code=502)
+        location_ids = sorted(set(location_ids) | set(data["location_ids"]))
+    if not location_ids or not parameter_ids:
+        return JSONResponse({"error": "Geef tenminste één locatie en parameter op"}, status_code=400)
     
-    return api_url, loc_status, loc_df, loc_options, param_status, param_df, param_options
+    try:
+        start_time = format_date(start_date) if start_date else None
+        end_time = format_date(end_date) if end_date else None
+    except ValueError:
+        return JSONResponse({"error": "Ongeldig datumformaat. Gebruik YYYY-MM-DD."}, status_code=400)
+    
+    sub_requests, warning = prepare_timeseries_requests(api_url, location_ids, parameter_ids, start_time, end_time)
+    chunks = []
+    with InFlightMemory() as in_flight:
+        for error, chunk_df in iter_timeseries_chunks(api_url, sub_requests):
+            if error:
+                return JSONResponse({"error": error}, status_code=502)
+            if chunk_df is not None:
+                chunks.append(chunk_df)
+                if not in_flight.add(chunk_df):
+                    return JSONResponse({"error": in_flight.refusal()}, status_code=503)
+        
+        df = combine_timeseries_chunks(chunks)
+        response = dataframe_response(df if df is not None else pd.DataFrame(columns=TIMESERIES_COLUMNS), output_format)
+    if warning:
+        response.headers["X-Query-Warning"] = warning
+    return response
+
+# Batch: {"api_url": ..., "format": "json" | "arrow", "queries": [{"locationIds": ..., "parameterIds": ...,
+# "startDate": ..., "endDate": ...}]}. Het antwoord bevat alle rijen met het volgnummer van de
+# opvraging in de kolom "query"; rijen die in meerdere opvragingen vallen komen vaker voor
+@api.post("/api/v1/timeseries/batch")
+@traced
+def api_timeseries_batch(body: dict = Body(...)):
+    queries = []
+    try:
+        for query in body.get("queries", []):
+            location_ids = query.get("locationIds", [])
+            parameter_ids = query.get("parameterIds", [])
+            queries.append({
+                "location_ids": split_ids(location_ids) if isinstance(location_ids, str) else list(location_ids),
+                "parameter_ids": split_ids(parameter_ids) if isinstance(parameter_ids, str) else list(parameter_ids),
+                "start_date": format_date(query["startDate"]) if query.get("startDate") else None,
+                "end_date": format_date(query["endDate"]) if query.get("endDate") else None
+            })
+    except ValueError:
+        return JSONResponse({"error": "Ongeldig datumformaat. Gebruik YYYY-MM-DD."}, status_code=400)
+    except (AttributeError, TypeError):
+        return JSONResponse({"error": "Ongeldige opvraging in de batch"}, status_code=400)
+    
+    if not queries or any(not query["location_ids"] or not query["parameter_ids"] for query in queries):
+        return JSONResponse({"error": "Geef per opvraging tenminste één locatie en parameter op"}, status_code=400)
+    output_format = body.get("format", "json")
+    if output_format not in ("json", "arrow"):
+        return JSONResponse({"error": "Ongeldig formaat. Gebruik json of arrow."}, status_code=400)
+    
+    api_url = normalize_api_url(body.get("api_url") or DEFAULT_API_URL)
+    results, batch_requests, errors, warnings_ = fetch_timeseries_batch(api_url, queries)
+    if errors:
+        return JSONResponse({"error": errors[0]}, status_code=502)
+    
+    frames = [result.assign(query=i) for i, result in enumerate(results) if result is not None]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=TIMESERIES_COLUMNS + ["query"])
+    response = dataframe_response(df, output_format)
+    response.headers["X-Upstream-Requests"] = str(len(batch_requests))
+    if warnings_:
+        response.headers["X-Query-Warning"] = warnings_[0]
+    return response
+
+# Vergelijking van twee webservices: per reeks het aantal events, ontbrekende events aan
+# beide kanten en de verschillen; de header X-Divergent-Series geeft het aantal afwijkende reeksen
+@api.get("/api/v1/timeseries/compare")
+@traced
+def api_timeseries_compare(
+    api_url_a: str = Query(..., alias="apiUrlA"),
+    api_url_b: str = Query(..., alias="apiUrlB"),
+    location_ids: str = Query(..., alias="locationIds"),
+    parameter_ids: str = Query(..., alias="parameterIds"),
+    start_date: str = Query(None, alias="startDate"),
+    end_date: str = Query(None, alias="endDate"),
+    output_format: Literal["json", "arrow"] = Query("json", alias="format")
+):
+    try:
+        query = {
+            "location_ids": split_ids(location_ids),
+            "parameter_ids": split_ids(parameter_ids),
+            "start_date": format_date(start_date) if start_date else None,
+            "end_date": format_date(end_date) if end_date else None
+        }
+    except ValueError:
+        return JSONResponse({"error": "Ongeldig datumformaat. Gebruik YYYY-MM-DD."}, status_code=400)
+    if not query["location_ids"] or not query["parameter_ids"]:
+        return JSONResponse({"error": "Geef tenminste één locatie en parameter op"}, status_code=400)
+    
+    sides = fetch_comparison(normalize_api_url(api_url_a), normalize_api_url(api_url_b), query)
+    for name, (_, _, errors, _) in zip("AB", sides):
+        if errors:
+            return JSONResponse({"error": f"{name}: {errors[0]}"}, status_code=502)
+    
+    stats = compare_timeseries(sides[0][0][0], sides[1][0][0])["stats"]
+    response = dataframe_response(stats, output_format)
+    response.headers["X-Divergent-Series"] = str(int(stats["afwijkend"].sum()))
+    return response
+
+@api.get("/api/v1/metrics")
+def api_metrics():
+    return {
+        **get_metrics(),
+        "memory_bytes": memory_usage(),
+        "memory_budget_bytes": int(MEMORY_BUDGET_MB * 1024 * 1024) if MEMORY_BUDGET_MB > 0 else None
+    }
 
 # Custom CSS voor Deltares/FEWS stijl
 css = """
@@ -529,6 +3580,26 @@ with gr.Blocks(title="FEWS Webservices Explorer", css=css) as demo:
                             value=[]
                         )
                         
+                        # Filter om locaties te selecteren op een attribuutwaarde of een FEWS filter
+                        with gr.Row():
+                            attribute_dropdown = gr.Dropdown(
+                                label="Locatie-attribuut",
+                                info="Selecteer alle locaties met een bepaalde attribuutwaarde",
+                                interactive=True,
+                                filterable=True
+                            )
+                            attribute_value_dropdown = gr.Dropdown(
+                                label="Attribuutwaarde",
+                                interactive=True,
+                                filterable=True
+                            )
+                            filter_dropdown = gr.Dropdown(
+                                label="Filter",
+                                info="Selecteer alle locaties van een filter van de webservice",
+                                interactive=True,
+                                filterable=True
+                            )
+                        
                         # Parameter dropdown met verbeterde styling
                         parameter_dropdown = gr.Dropdown(
                             label="Selecteer parameter(s)", 
@@ -552,20 +3623,94 @@ with gr.Blocks(title="FEWS Webservices Explorer", css=css) as demo:
                             info="Laat leeg voor alle beschikbare data"
                         )
                         timeseries_btn = gr.Button("Tijdseries ophalen", variant="primary", elem_classes="btn-primary")
+                        cancel_btn = gr.Button("Annuleren", variant="secondary")
+                        live_checkbox = gr.Checkbox(
+                            label="Live volgen",
+                            info=f"Haal elke {LIVE_POLL_INTERVAL:g} s nieuwe events op voor de opgehaalde tijdseries"
+                        )
             
         with gr.Row():
             timeseries_status = gr.Textbox(label="Status Tijdseries", interactive=False, elem_classes="status-message")
         
+        # Resultaat van de laatste opvraging per sessie en de timer voor de live modus
+        timeseries_result = gr.State(delete_callback=release_result)
+        live_timer = gr.Timer(LIVE_POLL_INTERVAL, active=False)
+        
         # Resultaten sectie
         with gr.Row():
             with gr.Column():
                 gr.Markdown("### Resultaten")
+                # Weergave-opties werken op het bewaarde resultaat, zonder nieuw verzoek
+                with gr.Row():
+                    aggregation_dropdown = gr.Dropdown(
+                        label="Aggregatie",
+                        choices=list(AGGREGATIONS),
+                        value="Ruw",
+                        info="Gemiddelde per uur of dag"
+                    )
+                    markers_checkbox = gr.Checkbox(label="Markers tonen", value=True)
+                    plot_type_radio = gr.Radio(
+                        label="Grafiektype",
+                        choices=["Lijnen", "Matrix"],
+                        value="Lijnen",
+                        info="Matrix: alle reeksen als één heatmap op een gemeenschappelijk tijdrooster"
+                    )
                 # Tab interface voor verschillende weergavemethoden
                 with gr.Tabs():
                     with gr.TabItem("Grafiek"):
                         timeseries_plot = gr.Plot(label="Tijdseries")
                     with gr.TabItem("Tabel"):
-                        timeseries_df = gr.DataFrame(label="Tijdseries Data")
+                        timeseries_summary = gr.DataFrame(label="Samenvatting per reeks", interactive=False)
+                        timeseries_df = gr.DataFrame(label="Tijdseries Data", interactive=False)
+                        with gr.Row():
+                            previous_page_btn = gr.Button("Vorige", size="sm")
+                            table_page = gr.Number(label="Pagina", value=1, precision=0, minimum=1)
+                            next_page_btn = gr.Button("Volgende", size="sm")
+                        table_page_info = gr.Markdown()
+                    with gr.TabItem("Gaten"):
+                        gaps_table = gr.DataFrame(label=f"Gaten per reeks (de langste {GAP_TABLE_MAX_ROWS})", interactive=False)
+                    with gr.TabItem("Correlatie"):
+                        correlation_btn = gr.Button("Correlatie berekenen")
+                        correlation_plot = gr.Plot(label="Correlatie")
+                        correlation_table = gr.DataFrame(label="Sterkst gecorreleerde paren", interactive=False)
+        
+        # Batch-opvragingen
+        with gr.Accordion("Batch-opvragingen", open=False):
+            gr.Markdown("Verzamel meerdere selecties (locaties, parameters, periode) en haal ze samen op. "
+                        "Overlappende delen worden maar één keer bij de webservice opgevraagd.")
+            batch_queue = gr.State([])
+            with gr.Row():
+                add_batch_btn = gr.Button("Selectie aan batch toevoegen")
+                clear_batch_btn = gr.Button("Batch leegmaken")
+                run_batch_btn = gr.Button("Batch ophalen", variant="primary")
+            batch_status = gr.Textbox(label="Status batch", interactive=False)
+            batch_table = gr.DataFrame(label="Opvragingen in de batch", interactive=False)
+            batch_file = gr.File(label="Resultaten downloaden (CSV)")
+        
+        # Vergelijken van twee webservices
+        with gr.Accordion("Vergelijken", open=False):
+            gr.Markdown("Haal de huidige selectie (locaties, parameters, periode) gelijktijdig op bij de "
+                        "webservice hierboven (A) en een tweede webservice (B) en vergelijk de reeksen. "
+                        "Alleen afwijkende reeksen worden geplot.")
+            with gr.Row():
+                compare_url_input = gr.Textbox(label="API URL B", placeholder="Bijvoorbeeld de productie-omgeving")
+                compare_btn = gr.Button("Vergelijken", variant="primary")
+            compare_status = gr.Textbox(label="Status vergelijking", interactive=False)
+            compare_table = gr.DataFrame(label="Verschillen per reeks", interactive=False)
+            compare_plot = gr.Plot(label="Afwijkende reeksen")
+        
+        # Beheerpaneel, alleen met ADMIN_PANEL=true (zonder paneel zijn de acties ook niet gekoppeld)
+        if ADMIN_PANEL:
+            with gr.Accordion("Beheer", open=False):
+                profiling_checkbox = gr.Checkbox(
+                    label="Profilering inschakelen",
+                    info="Neem van elke volgende verbinding en tijdseries-opvraging een sampling-profiel op, met de tijd per fase"
+                )
+                refresh_profiles_btn = gr.Button("Profielen vernieuwen")
+                profiles_table = gr.DataFrame(label="Opgenomen profielen", interactive=False)
+                profile_dropdown = gr.Dropdown(label="Profiel", interactive=True)
+                profile_stages = gr.DataFrame(label="Tijd per fase", interactive=False)
+                profile_file = gr.File(label="Profiel downloaden (speedscope)")
         
         # Footer
         with gr.Row(elem_classes="footer"):
@@ -588,17 +3733,127 @@ with gr.Blocks(title="FEWS Webservices Explorer", css=css) as demo:
             location_dropdown,
             parameters_status,
             parameters_df,
-            parameter_dropdown
+            parameter_dropdown,
+            attribute_dropdown,
+            filter_dropdown
         ]
     )
     
-    # Timeseries knop actie
-    timeseries_btn.click(
+    # Alleen combinaties met beschikbare tijdseries aanbieden. De input-events reageren
+    # alleen op keuzes van de gebruiker, zodat de dropdowns elkaar niet blijven bijwerken
+    location_dropdown.input(
+        restrict_parameter_choices,
+        inputs=[api_url_input, location_dropdown],
+        outputs=[parameter_dropdown]
+    )
+    parameter_dropdown.input(
+        restrict_location_choices,
+        inputs=[api_url_input, parameter_dropdown],
+        outputs=[location_dropdown]
+    )
+    
+    # Attribuutfilter acties
+    attribute_dropdown.change(
+        update_attribute_values,
+        inputs=[api_url_input, attribute_dropdown],
+        outputs=[attribute_value_dropdown]
+    )
+    attribute_value_dropdown.change(
+        select_locations_by_attribute,
+        inputs=[api_url_input, attribute_dropdown, attribute_value_dropdown],
+        outputs=[location_dropdown]
+    )
+    filter_dropdown.change(
+        select_locations_by_filter,
+        inputs=[api_url_input, filter_dropdown],
+        outputs=[location_dropdown]
+    )
+    
+    # Tabelweergave: samenvatting, pagina, paginanummer, pagina-informatie en gaten
+    table_components = [timeseries_summary, timeseries_df, table_page, table_page_info, gaps_table]
+    
+    # Timeseries knop actie; opnieuw klikken start een nieuwe opvraging die de vorige annuleert
+    timeseries_event = timeseries_btn.click(
         fetch_timeseries, 
-        inputs=[api_url_input, location_dropdown, parameter_dropdown, start_date_input, end_date_input], 
-        outputs=[timeseries_status, timeseries_df, timeseries_plot]
+        inputs=[api_url_input, location_dropdown, parameter_dropdown, start_date_input, end_date_input,
+                timeseries_result, aggregation_dropdown, markers_checkbox, plot_type_radio],
+        outputs=[timeseries_status, *table_components, timeseries_plot, timeseries_result],
+        trigger_mode="multiple",
+        concurrency_limit=TIMESERIES_CONCURRENCY_LIMIT
+    )
+    
+    # Weergave-opties acties
+    for view_control in (aggregation_dropdown, markers_checkbox, plot_type_radio):
+        view_control.change(
+            update_view,
+            inputs=[timeseries_result, aggregation_dropdown, markers_checkbox, plot_type_radio],
+            outputs=[timeseries_status, *table_components, timeseries_plot, timeseries_result]
+        )
+    
+    # Live modus acties
+    live_checkbox.change(toggle_live, inputs=[live_checkbox], outputs=[live_timer])
+    live_timer.tick(
+        poll_live_timeseries,
+        inputs=[timeseries_result, aggregation_dropdown, markers_checkbox, plot_type_radio],
+        outputs=[timeseries_status, *table_components, timeseries_plot, timeseries_result]
+    )
+    
+    # Bladeren door de tabel; alleen de gevraagde pagina gaat naar de browser
+    table_page_outputs = [timeseries_df, table_page, table_page_info]
+    previous_page_btn.click(previous_table_page, inputs=[timeseries_result, table_page], outputs=table_page_outputs)
+    next_page_btn.click(next_table_page, inputs=[timeseries_result, table_page], outputs=table_page_outputs)
+    table_page.submit(show_table_page, inputs=[timeseries_result, table_page], outputs=table_page_outputs)
+    
+    # Correlatie tussen de reeksen van de huidige weergave
+    correlation_btn.click(
+        show_correlation,
+        inputs=[timeseries_result],
+        outputs=[correlation_plot, correlation_table, timeseries_result]
+    )
+    
+    # Batch acties
+    add_batch_btn.click(
+        add_batch_query,
+        inputs=[batch_queue, location_dropdown, parameter_dropdown, start_date_input, end_date_input],
+        outputs=[batch_queue, batch_table, batch_status]
+    )
+    clear_batch_btn.click(clear_batch, outputs=[batch_queue, batch_table, batch_status])
+    run_batch_btn.click(
+        run_batch,
+        inputs=[api_url_input, batch_queue],
+        outputs=[batch_status, batch_table, batch_file],
+        concurrency_limit=TIMESERIES_CONCURRENCY_LIMIT
+    )
+    
+    # Vergelijken actie
+    compare_btn.click(
+        run_comparison,
+        inputs=[api_url_input, compare_url_input, location_dropdown, parameter_dropdown, start_date_input, end_date_input],
+        outputs=[compare_status, compare_table, compare_plot],
+        concurrency_limit=TIMESERIES_CONCURRENCY_LIMIT
+    )
+    
+    # Beheerpaneel acties
+    if ADMIN_PANEL:
+        profiling_checkbox.change(set_profiling, inputs=[profiling_checkbox], queue=False)
+        refresh_profiles_btn.click(list_profiles, outputs=[profiles_table, profile_dropdown])
+        profile_dropdown.change(show_profile, inputs=[profile_dropdown], outputs=[profile_stages, profile_file])
+    
+    # Annuleren knop actie
+    cancel_btn.click(
+        cancel_timeseries,
+        outputs=[timeseries_status],
+        cancels=[timeseries_event],
+        queue=False
     )
 
+# Koppel de Gradio UI aan de REST API, zodat beide op dezelfde poort draaien
+app = gr.mount_gradio_app(api, demo, path="/")
+
 # Start de app
 if __name__ == "__main__":
-    demo.launch()
+    uvicorn.run(
+        app,
+        host=os.getenv("GRADIO_SERVER_NAME", "127.0.0.1"),
+        port=int(os.getenv("GRADIO_SERVER_PORT", "7860"))
+    )
@@ -0,0 +1,385 @@
+# Load test voor de FEWS Webservices Explorer.
+#
+# Simuleert een oplopend aantal gelijktijdige sessies die via de Gradio event API
+# verbinden ("Verbinden en data ophalen") en tijdseries ophalen ("Tijdseries ophalen").
+# Standaard wordt een lokale nagebootste FEWS webservice gestart en de app zelf als
+# subproces, zodat de meting niet afhangt van een externe webservice.
+#
+# Gebruik:
+#   python src/loadtest.py --levels 1,2,4,8,16 --iterations 5
+#   python src/loadtest.py --app-url http://localhost:7860 --api-url https://.../FewsWebServices
+#   python src/loadtest.py --api-url https://.../FewsWebServices --location-ids A,B,C --parameter-ids H.meting
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import requests
+from gradio_client import Client
+from gradio_client.utils import Status
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# Nagebootste FEWS webservice met locaties, parameters, filters (één per regio) en uurlijkse tijdseries
+class StandInFews:
+    def __init__(self, n_locations=200, parameters=("H.meting", "Q.meting", "WATHTE.berekend"), latency=0.05):
+        self.location_ids = [f"LOC{i:04d}" for i in range(n_locations)]
+        self.parameter_ids = list(parameters)
+        self.latency = latency
+        self.server = None
+
+    def filter_locations(self, filter_id):
+        if filter_id == "alle_locaties":
+            return self.location_ids
+        return [location_id for i, location_id in enumerate(self.location_ids) if filter_id == f"regio_{i % 10}"]
+
+    def filters(self):
+        return {"filters": [{
+            "id": "alle_locaties",
+            "name": "Alle locaties",
+            "child": [{"id": f"regio_{k}", "name": f"Regio {k}"} for k in range(10)]
+        }]}
+
+    def locations(self, query):
+        filter_id = query.get("filterId", [None])[0]
+        selected = set(self.filter_locations(filter_id)) if filter_id else None
+        return {"locations": [
+            {
+                "locationId": location_id,
+                "description": f"Locatie {location_id}",
+                "shortName": location_id,
+                "lat": 52.0 + i * 0.001,
+                "lon": 5.0 + i * 0.001,
+                "attributes": [{"id": "regio", "text": f"Regio {i % 10}"}]
+            }
+            for i, location_id in enumerate(self.location_ids)
+            if selected is None or location_id in selected
+        ]}
+
+    def parameters(self):
+        return {"timeSeriesParameters": [
+            {"id": parameter_id, "name": parameter_id, "unit": "m"} for parameter_id in self.parameter_ids
+        ]}
+
+    def timeseries(self, query):
+        if "filterId" in query:
+            location_ids = self.filter_locations(query["filterId"][0])
+        else:
+            location_ids = [i for i in query.get("locationIds", [""])[0].split(",") if i in self.location_ids]
+        parameter_ids = [p for p in query.get("parameterIds", [""])[0].split(",") if p in self.parameter_ids]
+
+        end = parse_time(query.get("endTime", [None])[0]) or datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        start = parse_time(query.get("startTime", [None])[0]) or end - timedelta(days=7)
+        hours = max(int((end - start).total_seconds() // 3600) + 1, 0)
+
+        if query.get("onlyHeaders", ["false"])[0] == "true":
+            headers = []
+            for location_id in location_ids:
+                for parameter_id in parameter_ids:
+                    header = {
+                        "locationId": location_id,
+                        "parameterId": parameter_id,
+                        "timeStep": {"unit": "second", "multiplier": "3600"},
+                        "startDate": pi_time(start),
+                        "endDate": pi_time(end)
+                    }
+                    if query.get("showStatistics", ["false"])[0] == "true" and hours:
+                        header.update({
+                            "firstValueTime": pi_time(start),
+                            "lastValueTime": pi_time(start + timedelta(hours=hours - 1)),
+                            "valueCount": str(hours)
+                        })
+                    headers.append({"header": header})
+            return {"timeSeries": headers}
+
+        timestamps = [(start + timedelta(hours=h)).strftime("%Y-%m-%dT%H:%M:%SZ") for h in range(hours)]
+
+        results = []
+        for i, location_id in enumerate(location_ids):
+            for j, parameter_id in enumerate(parameter_ids):
+                results.append({
+                    "location": {"properties": {"locationId": location_id}},
+                    "observationType": {"parameterCode": parameter_id},
+                    "events": [
+                        {"timeStamp": timestamp, "value": f"{math.sin(h / 12 + i) + j:.3f}"}
+                        for h, timestamp in enumerate(timestamps)
+                    ]
+                })
+        return {"results": results}
+
+    def start(self, port=0):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path.endswith("/locations"):
+                    body = stand_in.locations(query)
+                elif url.path.endswith("/filters"):
+                    body = stand_in.filters()
+                elif url.path.endswith("/parameters"):
+                    body = stand_in.parameters()
+                elif url.path.endswith("/timeseries"):
+                    body = stand_in.timeseries(query)
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                time.sleep(stand_in.latency)
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}/FewsWebServices/rest/fewspiservice/v1"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+def parse_time(value):
+    if not value:
+        return None
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+
+def pi_time(value):
+    return {"date": value.strftime("%Y-%m-%d"), "time": value.strftime("%H:%M:%S")}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# Start de app als subproces, zodat ook het geheugengebruik (RSS) gemeten kan worden
+def start_app(port, extra_env):
+    env = {**os.environ, "GRADIO_SERVER_NAME": "127.0.0.1", "GRADIO_SERVER_PORT": str(port), **extra_env}
+    process = subprocess.Popen([sys.executable, APP_PATH], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}/"
+    for _ in range(120):
+        if process.poll() is not None:
+            raise RuntimeError("De app is onverwacht gestopt")
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return process, url
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("De app is niet binnen 60 s gestart")
+
+# RSS (in MB) van een proces, uit /proc (alleen Linux)
+def read_rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+# Voer een Gradio event uit en meet de wachttijd in de queue en de totale tijd
+def run_event(client, api_name, *args):
+    started = time.perf_counter()
+    job = client.submit(*args, api_name=api_name)
+    queue_wait = None
+    while not job.done():
+        if queue_wait is None and job.status().code in (Status.PROCESSING, Status.ITERATING):
+            queue_wait = time.perf_counter() - started
+        time.sleep(0.005)
+    job.result()
+    # Als het event al klaar is voordat de verwerking is waargenomen, is de wachttijd onbekend
+    return time.perf_counter() - started, queue_wait
+
+# Eén gesimuleerde gebruiker: verbinden en daarna een aantal keer tijdseries ophalen
+def run_session(app_url, api_url, location_ids, parameter_ids, args, results, start_barrier):
+    client = Client(app_url, verbose=False)
+    start_barrier.wait()
+    try:
+        simulate_user(client, api_url, location_ids, parameter_ids, args, results)
+    finally:
+        # Sluit de heartbeat-verbinding, anders blijft de app bij het afsluiten wachten
+        client.close()
+
+def simulate_user(client, api_url, location_ids, parameter_ids, args, results):
+    period_end = datetime.strptime(args.end_date, "%Y-%m-%d")
+    for _ in range(args.iterations):
+        for step in ("connect", "timeseries"):
+            try:
+                if step == "connect":
+                    latency, queue_wait = run_event(client, "/update_api_url", api_url)
+                else:
+                    end = period_end - timedelta(days=random.randint(0, 300))
+                    start = end - timedelta(days=args.days)
+                    latency, queue_wait = run_event(
+                        client, "/fetch_timeseries", api_url,
+                        random.sample(location_ids, min(args.locations, len(location_ids))), parameter_ids[:args.parameters],
+                        start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+                    )
+                results.append({"step": step, "latency": latency, "queue_wait": queue_wait, "error": None})
+            except Exception as e:
+                results.append({"step": step, "latency": None, "queue_wait": None, "error": str(e)})
+
+# Locatie- en parameter-IDs van de webservice, opgehaald via de REST API van de app
+def fetch_catalog_ids(app_url, api_url):
+    ids = []
+    for kind in ("locations", "parameters"):
+        response = requests.get(f"{app_url.rstrip('/')}/api/v1/{kind}", params={"api_url": api_url}, timeout=300)
+        response.raise_for_status()
+        ids.append(sorted({row["id"] for row in response.json()}))
+    return ids
+
+def split_ids(ids):
+    return [item.strip() for item in ids.split(",") if item.strip()] if ids else []
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": p50, "p95": p95, "p99": p99}
+
+def run_level(concurrency, app_url, api_url, location_ids, parameter_ids, args, pid):
+    results = []
+    start_barrier = threading.Barrier(concurrency + 1)
+    threads = [
+        threading.Thread(target=run_session, args=(app_url, api_url, location_ids, parameter_ids, args, results, start_barrier))
+        for _ in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+
+    # Bemonster het geheugengebruik van de app zolang de sessies lopen
+    rss_samples = []
+    started = time.perf_counter()
+    while any(thread.is_alive() for thread in threads):
+        if pid is not None:
+            rss = read_rss_mb(pid)
+            if rss is not None:
+                rss_samples.append(rss)
+        time.sleep(0.1)
+    duration = time.perf_counter() - started
+
+    report = {"concurrency": concurrency, "duration_s": duration, "rss_max_mb": max(rss_samples) if rss_samples else None}
+    for step in ("connect", "timeseries"):
+        step_results = [r for r in results if r["step"] == step]
+        ok = [r for r in step_results if r["error"] is None]
+        report[step] = {
+            "requests": len(step_results),
+            "errors": len(step_results) - len(ok),
+            "latency_s": percentiles([r["latency"] for r in ok]),
+            "queue_wait_s": percentiles([r["queue_wait"] for r in ok if r["queue_wait"] is not None]),
+            "first_error": next((r["error"] for r in step_results if r["error"]), None)
+        }
+    return report
+
+def format_seconds(value):
+    return "-" if value is None else f"{value:.2f}"
+
+def print_report(report):
+    rss = "-" if report["rss_max_mb"] is None else f"{report['rss_max_mb']:.0f}"
+    for step in ("connect", "timeseries"):
+        stats = report[step]
+        print(
+            f"{report['concurrency']:>5} {step:<11} {stats['requests']:>6} {stats['errors']:>6} "
+            f"{format_seconds(stats['latency_s']['p50']):>7} {format_seconds(stats['latency_s']['p95']):>7} "
+            f"{format_seconds(stats['latency_s']['p99']):>7} {format_seconds(stats['queue_wait_s']['p50']):>8} "
+            f"{format_seconds(stats['queue_wait_s']['p95']):>8} {rss:>8}"
+        )
+        if stats["first_error"]:
+            print(f"      eerste fout: {stats['first_error']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test voor de FEWS Webservices Explorer")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="Aantallen gelijktijdige sessies, oplopend (standaard: 1,2,4,8,16)")
+    parser.add_argument("--iterations", type=int, default=3, help="Aantal keer verbinden + tijdseries ophalen per sessie")
+    parser.add_argument("--locations", type=int, default=5, help="Aantal locaties per tijdseries-opvraging")
+    parser.add_argument("--parameters", type=int, default=2, help="Aantal parameters per tijdseries-opvraging")
+    parser.add_argument("--days", type=int, default=30, help="Lengte van de opgevraagde periode in dagen")
+    parser.add_argument("--app-url", help="URL van een al draaiende app; zonder deze optie wordt de app gestart")
+    parser.add_argument("--app-pid", type=int, help="Proces-ID van een al draaiende app, voor de RSS meting")
+    parser.add_argument("--api-url", help="FEWS webservice URL; zonder deze optie wordt een nagebootste webservice gestart")
+    parser.add_argument("--location-ids", help="Komma-gescheiden locatie-IDs om uit te kiezen (standaard: de catalogus van --api-url)")
+    parser.add_argument("--parameter-ids", help="Komma-gescheiden parameter-IDs (standaard: de catalogus van --api-url)")
+    parser.add_argument("--end-date", default=datetime.now().strftime("%Y-%m-%d"),
+                        help="Laatste einddatum (YYYY-MM-DD) van de opgevraagde perioden; de perioden eindigen willekeurig tot 300 dagen eerder (standaard: vandaag)")
+    parser.add_argument("--stand-in-locations", type=int, default=200, help="Aantal locaties in de nagebootste webservice")
+    parser.add_argument("--stand-in-latency", type=float, default=0.05, help="Vertraging (s) per verzoek van de nagebootste webservice")
+    parser.add_argument("--no-cache", action="store_true", help="Schakel de schijfcache van de gestarte app uit")
+    parser.add_argument("--output", help="Schrijf het rapport ook als JSON naar dit bestand")
+    args = parser.parse_args()
+
+    stand_in = None
+    process = None
+    try:
+        if args.api_url:
+            api_url = args.api_url
+        else:
+            stand_in = StandInFews(args.stand_in_locations, latency=args.stand_in_latency)
+            api_url = stand_in.start()
+            location_ids = stand_in.location_ids
+            parameter_ids = stand_in.parameter_ids
+
+        if args.app_url:
+            app_url = args.app_url
+            pid = args.app_pid
+        else:
+            extra_env = {"SERIES_CACHE_MAX_MB": "0"} if args.no_cache else {}
+            process, app_url = start_app(free_port(), extra_env)
+            pid = process.pid
+
+        # Een echte webservice: kies uit de opgegeven IDs of uit de catalogus van de webservice
+        if args.api_url:
+            location_ids, parameter_ids = split_ids(args.location_ids), split_ids(args.parameter_ids)
+            if not location_ids or not parameter_ids:
+                catalog_location_ids, catalog_parameter_ids = fetch_catalog_ids(app_url, api_url)
+                location_ids = location_ids or catalog_location_ids
+                parameter_ids = parameter_ids or catalog_parameter_ids
+            if not location_ids or not parameter_ids:
+                sys.exit(f"Geen locaties of parameters gevonden voor {api_url}; geef ze op met --location-ids en --parameter-ids")
+            print(f"{len(location_ids)} locaties en {len(parameter_ids)} parameters om uit te kiezen")
+
+        print(f"App: {app_url}  webservice: {api_url}")
+        print(f"{'sessies':>5} {'stap':<11} {'aantal':>6} {'fouten':>6} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} "
+              f"{'wacht50':>8} {'wacht95':>8} {'RSS MB':>8}")
+
+        reports = []
+        for concurrency in [int(level) for level in args.levels.split(",")]:
+            report = run_level(concurrency, app_url, api_url, location_ids, parameter_ids, args, pid)
+            reports.append(report)
+            print_report(report)
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(reports, f, indent=2)
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if stand_in is not None:
+            stand_in.stop()
+
+if __name__ == "__main__":
+    main()